@@ -0,0 +1,398 @@
+import argparse
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from bs4 import BeautifulSoup
+
+import HP_Printer_Scrape as futuresmart
+from collectors import EwsCollector, SnmpCollector
+from ews_parser import extract_pages
+from metrics_store import MetricsStore, export_workbook
+from metrics_store import PAGES as PAGE_COSTS
+from printer_pipeline import export_store, m501dn
+from printer_poller import FleetPoller
+from printer_processing import calculate_difference, create_printer_usage_table
+from printer_simulator import PAGES, PrinterSimulator, SimulatedPrinter, SnmpAgentSimulator
+from run_metrics import percentile
+from synthetic_history import make_history, make_messy_history, reference_daily_usage
+
+
+def _timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+# Storage: the old per-printer read_excel/concat/to_excel against one batched
+# insert into the metrics store plus a single export
+def bench_storage(history_sizes, run_size):
+    run = make_history(run_size).to_dict('records')
+    print(f"{'history rows':>12} {'excel per printer (s)':>22} {'store + export (s)':>19}")
+    for size in history_sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            excel_file = os.path.join(tmp, 'Printer_Metrics.xlsx')
+            make_history(size).to_excel(excel_file, sheet_name='printers', index=False)
+
+            def old_path():
+                for row in run:
+                    prev_df = pd.read_excel(excel_file)
+                    df = pd.concat([prev_df, pd.DataFrame([row])], ignore_index=True)
+                    df.to_excel(excel_file, sheet_name='printers', index=False)
+
+            store = MetricsStore(os.path.join(tmp, 'printer_metrics.db'))
+            store.insert_readings(make_history(size).to_dict('records'))
+
+            def new_path():
+                store.insert_readings(run)
+                export_store(store, excel_file)
+
+            old = _timed(old_path)
+            new = _timed(new_path)
+            store.close()
+        print(f'{size:>12} {old:>22.2f} {new:>19.2f}')
+
+
+# Deltas: check the vectorized engine against the reference loop, then time
+# it on large histories
+def bench_deltas(check_size, history_sizes):
+    history = make_messy_history(check_size, printers=max(check_size // 50, 1))
+    expected = reference_daily_usage(history)
+    actual = calculate_difference(history)
+    for col in ['A4 page', 'A5 page']:
+        same = (expected[col] == actual[col]) | (expected[col].isna() & actual[col].isna())
+        mismatches = (~same).sum()
+        if mismatches:
+            raise SystemExit(f'{col}: {mismatches} of {check_size} rows differ from the reference')
+    print(f'{check_size} messy rows match the reference implementation')
+
+    reference_time = _timed(lambda: reference_daily_usage(history))
+    print(f'reference loop on {check_size} rows: {reference_time:.2f}s')
+    print(f"{'history rows':>12} {'vectorized (s)':>15}")
+    for size in history_sizes:
+        history = make_messy_history(size)
+        print(f'{size:>12} {_timed(lambda: calculate_difference(history)):>15.2f}')
+
+
+# EWS pages as the printers serve them: the canned simulator pages padded with
+# the navigation and status markup around the values we read
+def saved_pages(family, filler_rows=400):
+    printer = SimulatedPrinter('10.0.0.1', family=family, a4=123456, a5=7890, filler_rows=filler_rows)
+    return {path: printer.render(path) for path in PAGES[family]}
+
+
+# The BeautifulSoup extraction the scrapers used before the ews_parser layer
+def _bs4_futuresmart(pages):
+    soup = BeautifulSoup(pages['/hp/device/InternalPages/Index?id=UsagePage'], 'html.parser')
+    a4 = int(soup.find('td', {'id': futuresmart.A4}).text.replace(',', ''))
+    a5 = int(soup.find('td', {'id': futuresmart.A5}).text.replace(',', ''))
+    soup = BeautifulSoup(pages['/hp/device/DeviceStatus/Index'], 'html.parser')
+    ip = soup.find('p', {'id': futuresmart.ipaddress}).text
+    soup = BeautifulSoup(pages['/hp/device/DeviceInformation/View'], 'html.parser')
+    model = soup.find('p', {'id': futuresmart.model}).text
+    soup = BeautifulSoup(pages['/network_id.htm'], 'html.parser')
+    name = soup.find('input', {'id': 'IPv4_HostName'}).get('value')
+    return a4, a5, ip, model, name
+
+def _bs4_m501dn(pages):
+    soup = BeautifulSoup(pages['/info_configuration.html?tab=Home&menu=DevConfig'], 'html.parser')
+    count = int(soup.find('h3', class_='subTitle', string='Impressions').find_next('td', class_='itemFont').text.replace(',', ''))
+    model = soup.find('td', class_='itemFont').text
+    soup = BeautifulSoup(pages['/info_config_network.html?tab=Home&menu=NetConfig'], 'html.parser')
+    ip = soup.find_all('td', class_='itemFont')[1].text.strip()
+    soup = BeautifulSoup(pages['/info_config_network.html?tab=Networking&menu=NetConfig'], 'html.parser')
+    name = soup.find('h3', class_='subTitle', string='Identification réseau').find_next('td', class_='itemFont').text.strip()
+    return count, model, ip, name
+
+
+# Parsing: the BeautifulSoup extractors against ews_parser on saved pages
+def bench_parse(printers, filler_rows):
+    scrapers = {
+        'futuresmart': (futuresmart.printer_urls, futuresmart.FIELDS, _bs4_futuresmart),
+        'm501dn': (m501dn.printer_urls, m501dn.FIELDS, _bs4_m501dn),
+    }
+    print(f"{'family':>12} {'page KB':>8} {'BeautifulSoup (ms)':>19} {'ews_parser (ms)':>16} {'speedup':>8}")
+    for family, (printer_urls, fields, bs4_extract) in scrapers.items():
+        pages = saved_pages(family, filler_rows)
+        # ews_parser works on the page keys of the scraper
+        keyed = {key: pages[url.split('10.0.0.1', 1)[1]] for key, url in printer_urls('10.0.0.1').items()}
+        extract_pages(fields, keyed)
+        bs4_extract(pages)
+
+        old = _timed(lambda: [bs4_extract(pages) for _ in range(printers)]) / printers * 1000
+        new = _timed(lambda: [extract_pages(fields, keyed) for _ in range(printers)]) / printers * 1000
+        size = sum(len(page) for page in pages.values()) / 1024
+        print(f'{family:>12} {size:>8.0f} {old:>19.2f} {new:>16.2f} {old / new:>7.1f}x')
+
+
+# SNMP: fleet-wide poll time of the M501dn fleet over SNMP against the EWS
+# scrape, both against the simulator with the same per-answer latency
+def bench_snmp(printers, delay):
+    with PrinterSimulator() as fleet, SnmpAgentSimulator(fleet) as agent:
+        ip_addresses = [fleet.add_printer(i, family='m501dn', a5=1000 + i, delay=delay) for i in range(printers)]
+        collectors = {
+            'ews': EwsCollector(m501dn.poll_printer),
+            'snmp': SnmpCollector(m501dn.SNMP_FIELDS, m501dn.SNMP_DEFAULTS, port=agent.port),
+        }
+        print(f"{'collector':>10} {'printers':>9} {'polled':>7} {'wall (s)':>9} {'p95 (ms)':>9}")
+        for name, collector in collectors.items():
+            poller = FleetPoller()
+            start = time.perf_counter()
+            rows = poller.run(ip_addresses, collector)
+            wall = time.perf_counter() - start
+            p95 = poller.metrics.summary()['fetch_p95'] or 0
+            print(f'{name:>10} {printers:>9} {len(rows):>7} {wall:>9.2f} {p95 * 1000:>9.1f}')
+
+
+
+# Export: every sheet of a run, written the way each pipeline version did it
+def export_sheets(history):
+    daily_usage = calculate_difference(history)
+    return {
+        'printers': history,
+        'pages': pd.DataFrame(PAGE_COSTS, columns=['Page ID', 'Page Size', 'Cost']),
+        'Printer Daily Usage': daily_usage,
+        'Printer Usage': create_printer_usage_table(daily_usage),
+        'Workcenter Printers': daily_usage.assign(**{'WorkCenter ID': daily_usage['Printer ID'] % 40}),
+    }
+
+# The exports before the streaming one: DataFrames written to the workbook in
+# openpyxl's append mode, replacing their sheets and keeping the others
+def append_workbook(excel_file, sheets):
+    if os.path.exists(excel_file):
+        writer = pd.ExcelWriter(excel_file, engine='openpyxl', mode='a', if_sheet_exists='replace')
+    else:
+        writer = pd.ExcelWriter(excel_file, engine='openpyxl')
+    with writer:
+        for sheet_name, df in sheets.items():
+            df.to_excel(writer, sheet_name=sheet_name, index=False)
+
+EXPORTS = {
+    # One openpyxl append per script: scrapers, printer_processing, merge tables
+    'per-script': lambda excel_file, sheets: [
+        append_workbook(excel_file, {name: sheets[name] for name in names})
+        for names in (['printers', 'pages'], ['Printer Daily Usage', 'Printer Usage'], ['Workcenter Printers'])],
+    # Every sheet in one openpyxl append, the pipeline before the streaming export
+    'append-once': append_workbook,
+    # Write-only openpyxl workbook written from scratch
+    'streaming': export_workbook,
+}
+
+# Run one export in this process and print its wall time (the worker side of
+# bench_export)
+def export_once(variant, rows, excel_file):
+    sheets = export_sheets(make_history(rows))
+    if variant == 'data':
+        print(0.0)
+        return
+    print(_timed(lambda: EXPORTS[variant](excel_file, sheets)))
+
+def bench_export(history_sizes):
+    here = os.path.dirname(os.path.abspath(__file__))
+    print(f"{'history rows':>12} {'export':>12} {'wall (s)':>9} {'peak RSS (MB)':>14}")
+    for size in history_sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            # 'data' only builds the sheets: the RSS floor of the other rows
+            for variant in ['data'] + list(EXPORTS):
+                # Every export updates the workbook left by the previous run
+                excel_file = os.path.join(tmp, f'{variant}.xlsx')
+                export_workbook(excel_file, export_sheets(make_history(size)))
+                # A fresh process per export, so its peak RSS is its own
+                code = f'import benchmark; benchmark.export_once({variant!r}, {size}, {excel_file!r})'
+                worker = subprocess.Popen([sys.executable, '-c', code], cwd=here, stdout=subprocess.PIPE, text=True)
+                output = worker.stdout.read()
+                worker.stdout.close()
+                _, _, usage = os.wait4(worker.pid, 0)
+                wall = float(output.split()[-1])
+                print(f'{size:>12} {variant:>12} {wall:>9.2f} {usage.ru_maxrss / 1024:>14.0f}')
+
+
+
+# Fleet: both scrape stages of the pipeline end to end, in a fresh process
+# against a simulated fleet. m501dn_share of the printers are M501dn,
+# offline_share are addresses nobody answers on, the others answer after
+# delay plus up to jitter seconds and error_rate of their answers are 500
+# errors. The fleet is drawn from seed, so two runs poll the same fleet.
+# Metrics the baseline gates on. p99 is reported only, on a fleet of dozens
+# it is one or two fetches.
+FLEET_METRICS = ['throughput', 'fetch_p50', 'fetch_p95', 'cpu', 'peak_rss']
+# Metrics where a higher value is the better one
+HIGHER_IS_BETTER = {'throughput'}
+
+def fleet_run(printers, m501dn_share, offline_share, delay, jitter, error_rate, filler_rows, seed):
+    here = os.path.dirname(os.path.abspath(__file__))
+    rng = random.Random(seed)
+    with PrinterSimulator() as fleet, tempfile.TemporaryDirectory() as tmp:
+        lists = {'futuresmart': [], 'm501dn': []}
+        offline = 0
+        for i in range(printers):
+            family = 'm501dn' if rng.random() < m501dn_share else 'futuresmart'
+            if rng.random() < offline_share:
+                address = fleet.add_offline(i)
+                offline += 1
+            else:
+                address = fleet.add_printer(i, family=family, a4=rng.randrange(10 ** 6), a5=rng.randrange(10 ** 4),
+                                            delay=delay, jitter=jitter, error_rate=error_rate,
+                                            filler_rows=filler_rows, seed=rng.random())
+            lists[family].append(address)
+        for family, ip_file in (('futuresmart', 'IP Address.txt'), ('m501dn', 'M501dn.txt')):
+            with open(os.path.join(tmp, ip_file), 'w') as file:
+                file.write('\n'.join(lists[family]) + '\n')
+
+        # --full: every printer is scraped as on a first run
+        code = "import printer_pipeline; printer_pipeline.main(['--to', 'scrape-m501dn', '--full'])"
+        env = dict(os.environ, PYTHONPATH=here + os.pathsep + os.environ.get('PYTHONPATH', ''))
+        start = time.perf_counter()
+        worker = subprocess.Popen([sys.executable, '-c', code], cwd=tmp, env=env, stdout=subprocess.DEVNULL)
+        _, status, usage = os.wait4(worker.pid, 0)
+        wall = time.perf_counter() - start
+        if status:
+            raise RuntimeError(f"Pipeline run failed with status {status}, see {tmp}/printer_metrics.log")
+
+        with open(os.path.join(tmp, 'printer_metrics.jsonl')) as file:
+            events = [json.loads(line) for line in file]
+        conn = sqlite3.connect(os.path.join(tmp, 'printer_metrics.db'))
+        try:
+            polled = conn.execute('SELECT COUNT(*) FROM readings').fetchone()[0]
+        finally:
+            conn.close()
+
+    # Latency of the pages served. Failed fetches mostly time the retry
+    # backoff against the offline hosts, and fetches cancelled when their
+    # printer failed (no status) time the rest of the run.
+    fetches = [event for event in events if event['kind'] == 'fetch']
+    latencies = [event['seconds'] for event in fetches
+                 if 'error' not in event and event.get('status') is not None]
+    summary = events[-1]
+    return {
+        'printers': printers,
+        'offline': offline,
+        'polled': polled,
+        'fetches': len(fetches),
+        'fetch_errors': summary['fetch_errors'],
+        'wall': round(wall, 3),
+        'scrape': summary['stages'].get('scrape'),
+        'throughput': round(polled / summary['stages']['scrape'], 2),
+        'fetch_p50': percentile(latencies, 50),
+        'fetch_p95': percentile(latencies, 95),
+        'fetch_p99': percentile(latencies, 99),
+        'cpu': round(usage.ru_utime + usage.ru_stime, 3),
+        'peak_rss': round(usage.ru_maxrss / 1024, 1),
+    }
+
+# Metrics of a result worse than the baseline by more than the tolerance
+def regressions(result, baseline, tolerance):
+    worse = []
+    for metric in FLEET_METRICS:
+        old, new = baseline.get(metric), result.get(metric)
+        if not old or new is None:
+            continue
+        change = (old - new) / old if metric in HIGHER_IS_BETTER else (new - old) / old
+        if change > tolerance:
+            worse.append(f'{metric} {old} -> {new} ({change:+.0%})')
+    return worse
+
+# Median of every metric over repeated runs, so one noisy run doesn't fail the
+# gate
+def median_result(runs):
+    return {metric: float(np.median([run[metric] for run in runs]))
+            if metric in FLEET_METRICS + ['fetch_p99', 'wall', 'scrape', 'fetches', 'fetch_errors'] else runs[0][metric]
+            for metric in runs[0]}
+
+def bench_fleet(sizes, m501dn_share, offline_share, delay, jitter, error_rate, filler_rows, seed, repeat=3,
+                baseline=None, save=None, tolerance=0.2):
+    print(f"{'printers':>8} {'offline':>8} {'polled':>7} {'fetches':>8} {'errors':>7} {'scrape (s)':>11} "
+          f"{'printers/s':>11} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9} {'CPU (s)':>8} {'peak RSS (MB)':>14}")
+    results = {}
+    for size in sizes:
+        runs = [fleet_run(size, m501dn_share, offline_share, delay, jitter, error_rate, filler_rows, seed)
+                for _ in range(repeat)]
+        result = median_result(runs)
+        result['polled'] = min(run['polled'] for run in runs)
+        results[str(size)] = result
+        print(f"{size:>8} {result['offline']:>8} {result['polled']:>7} {result['fetches']:>8.0f} "
+              f"{result['fetch_errors']:>7.0f} {result['scrape']:>11.2f} {result['throughput']:>11.1f} "
+              f"{result['fetch_p50'] * 1000:>9.1f} {result['fetch_p95'] * 1000:>9.1f} "
+              f"{result['fetch_p99'] * 1000:>9.1f} {result['cpu']:>8.2f} {result['peak_rss']:>14.0f}")
+
+    if save:
+        with open(save, 'w') as file:
+            json.dump(results, file, indent=2)
+    if baseline:
+        with open(baseline) as file:
+            baseline_results = json.load(file)
+        failed = False
+        for size, result in results.items():
+            if size not in baseline_results:
+                print(f'{size} printers: not in {baseline}, not compared')
+                continue
+            worse = regressions(result, baseline_results[size], tolerance)
+            if result['polled'] < baseline_results[size]['polled']:
+                worse.append(f"polled {baseline_results[size]['polled']} -> {result['polled']}")
+            for regression in worse:
+                print(f'{size} printers: REGRESSION {regression}')
+            failed = failed or bool(worse)
+        if failed:
+            sys.exit(1)
+        print(f'No regression against {baseline} (tolerance {tolerance:.0%}).')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Printer scraper benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    storage = commands.add_parser('storage', help='run time against history length for the readings storage')
+    storage.add_argument('--history', type=int, nargs='+', default=[1000, 10000, 50000])
+    storage.add_argument('--run-size', type=int, default=20, help='printers written per run')
+
+    deltas = commands.add_parser('deltas', help='daily usage delta engine correctness and speed')
+    deltas.add_argument('--check-size', type=int, default=20000, help='rows compared against the reference loop')
+    deltas.add_argument('--history', type=int, nargs='+', default=[100000, 1000000, 5000000])
+
+    parse = commands.add_parser('parse', help='EWS page extraction, BeautifulSoup against ews_parser')
+    parse.add_argument('--printers', type=int, default=200, help='printers extracted per family')
+    parse.add_argument('--filler-rows', type=int, default=400, help='extra table rows around the values on each page')
+
+    snmp = commands.add_parser('snmp', help='fleet poll time over SNMP against the EWS scrape')
+    snmp.add_argument('--printers', type=int, default=500)
+    snmp.add_argument('--delay', type=float, default=0.05, help='seconds each simulated answer takes')
+
+    export = commands.add_parser('export', help='workbook export wall time and peak RSS, streaming against openpyxl')
+    export.add_argument('--history', type=int, nargs='+', default=[10000, 50000])
+
+    fleet = commands.add_parser('fleet', help='both scrape flows end to end against a simulated fleet: throughput, '
+                                              'latency percentiles, CPU and peak RSS, checked against a baseline')
+    fleet.add_argument('--printers', type=int, nargs='+', default=[50, 500, 2000])
+    fleet.add_argument('--m501dn-share', type=float, default=0.3, help='share of M501dn printers')
+    fleet.add_argument('--offline-share', type=float, default=0.05, help='share of addresses nobody answers on')
+    fleet.add_argument('--delay', type=float, default=0.05, help='seconds each simulated answer takes')
+    fleet.add_argument('--jitter', type=float, default=0.05, help='up to this many seconds added to each answer')
+    fleet.add_argument('--error-rate', type=float, default=0.01, help='share of answers that are 500 errors')
+    fleet.add_argument('--filler-rows', type=int, default=400, help='extra table rows around the values on each page')
+    fleet.add_argument('--seed', type=int, default=0)
+    fleet.add_argument('--repeat', type=int, default=3, help='runs per fleet size, the median of each metric counts')
+    fleet.add_argument('--save', help='write the results to this JSON file, to use as a baseline')
+    fleet.add_argument('--baseline', help='JSON file of a previous --save; exit 1 if a metric got worse')
+    fleet.add_argument('--tolerance', type=float, default=0.2, help='relative change allowed against the baseline')
+
+    args = parser.parse_args()
+    if args.command == 'storage':
+        bench_storage(args.history, args.run_size)
+    elif args.command == 'deltas':
+        bench_deltas(args.check_size, args.history)
+    elif args.command == 'parse':
+        bench_parse(args.printers, args.filler_rows)
+    elif args.command == 'snmp':
+        bench_snmp(args.printers, args.delay)
+    elif args.command == 'export':
+        bench_export(args.history)
+    elif args.command == 'fleet':
+        bench_fleet(args.printers, args.m501dn_share, args.offline_share, args.delay, args.jitter, args.error_rate,
+                    args.filler_rows, args.seed, args.repeat, args.baseline, args.save, args.tolerance)
@@ -0,0 +1,82 @@
+import asyncio
+import logging
+from datetime import datetime
+
+from metrics_store import TIME_FORMAT
+from snmp import COMMUNITY, RETRIES, SNMP_PORT, TIMEOUT, SnmpClient, SnmpError
+
+# A collector is any coroutine function collector(poller, ip_address) that
+# returns the printer's row, the same shape as the scrapers' poll_printer. The
+# fleet poller runs whichever collector a model family is configured with.
+
+
+class EwsCollector:
+    # Scrape the printer's EWS HTML pages with the family's poll_printer
+    name = 'ews'
+
+    def __init__(self, poll_printer):
+        self.poll_printer = poll_printer
+
+    async def __call__(self, poller, ip_address):
+        return await self.poll_printer(poller, ip_address)
+
+
+class SnmpCollector:
+    # Read the row with one SNMP GET. fields maps a sheet column to its OID
+    # (None when the family has no usable OID for it) and defaults holds
+    # columns SNMP doesn't cover. When SNMP can't give every field, the
+    # printer goes through the fallback collector (the EWS scraper) instead.
+    name = 'snmp'
+
+    def __init__(self, fields, defaults=None, fallback=None, port=SNMP_PORT, community=COMMUNITY,
+                 timeout=TIMEOUT, retries=RETRIES):
+        self.fields = fields
+        self.defaults = defaults or {}
+        self.fallback = fallback
+        self.port = port
+        self.community = community
+        self.timeout = timeout
+        self.retries = retries
+        self._clients = {}
+
+    # Every OID is configured, otherwise the family always falls back
+    @property
+    def complete(self):
+        return all(oid is not None for oid in self.fields.values())
+
+    # One shared UDP socket per poller run, closed when the run ends
+    async def _client(self, poller):
+        loop = asyncio.get_running_loop()
+        if loop not in self._clients:
+            self._clients[loop] = asyncio.ensure_future(SnmpClient.open())
+            poller.on_close(lambda: self._clients.pop(loop).result().close())
+        return await self._clients[loop]
+
+    async def _fall_back(self, poller, ip_address, reason):
+        if self.fallback is None:
+            raise SnmpError(reason)
+        logging.info(f"{reason}, scraping {ip_address} over HTTP instead.")
+        return await self.fallback(poller, ip_address)
+
+    async def __call__(self, poller, ip_address):
+        if not self.complete:
+            return await self._fall_back(poller, ip_address, f"{ip_address} has no SNMP OID for every field")
+
+        host = ip_address.split(':')[0]
+        client = await self._client(poller)
+        try:
+            with poller.metrics.timer('fetch', printer=ip_address, url=f'snmp://{host}:{self.port}'):
+                values = await client.get(host, list(self.fields.values()), self.port, self.community,
+                                          self.timeout, self.retries)
+        except SnmpError as e:
+            return await self._fall_back(poller, ip_address, str(e))
+
+        row = dict(self.defaults)
+        for column, oid in self.fields.items():
+            if values.get(oid) is None:
+                return await self._fall_back(poller, ip_address, f"{ip_address} has no SNMP value for {column}")
+            row[column] = values[oid]
+        row.setdefault('IP Address', host)
+        row['Date'] = datetime.now().strftime(TIME_FORMAT)
+        logging.info("Done polling over SNMP." + ip_address)
+        return row
@@ -0,0 +1,163 @@
+import logging
+
+from lxml import etree
+
+# Pages are fed to the parser in chunks so the scan can stop as soon as every
+# field of the page has been found
+CHUNK_SIZE = 16384
+
+
+def _has_class(element, cls):
+    return cls in (element.get('class') or '').split()
+
+def _text(element):
+    return ''.join(element.itertext())
+
+
+# Matchers: find one element in the stream of closed elements and return its
+# raw value, or None while it hasn't shown up yet
+
+class ById:
+    # Element with the given id, its text or one of its attributes
+    def __init__(self, tag, element_id, attribute=None):
+        self.tag = tag
+        self.element_id = element_id
+        self.attribute = attribute
+
+    def start(self):
+        return self
+
+    def match(self, element):
+        if element.tag == self.tag and element.get('id') == self.element_id:
+            return element.get(self.attribute) if self.attribute else _text(element)
+        return None
+
+
+class NthByClass:
+    # The nth (0-based) element with the given tag and class
+    def __init__(self, tag, cls, n=0):
+        self.tag = tag
+        self.cls = cls
+        self.n = n
+
+    def start(self):
+        return _NthScan(self)
+
+
+class _NthScan:
+    def __init__(self, matcher):
+        self.matcher = matcher
+        self.seen = 0
+
+    def match(self, element):
+        if element.tag == self.matcher.tag and _has_class(element, self.matcher.cls):
+            if self.seen == self.matcher.n:
+                return _text(element)
+            self.seen += 1
+        return None
+
+
+class AfterHeading:
+    # First tag.cls element after the heading (tag.class) with the given text
+    def __init__(self, heading_tag, heading_cls, heading, tag, cls):
+        self.heading_tag = heading_tag
+        self.heading_cls = heading_cls
+        self.heading = heading
+        self.tag = tag
+        self.cls = cls
+
+    def start(self):
+        return _AfterHeadingScan(self)
+
+
+class _AfterHeadingScan:
+    def __init__(self, matcher):
+        self.matcher = matcher
+        self.found_heading = False
+
+    def match(self, element):
+        matcher = self.matcher
+        if not self.found_heading:
+            self.found_heading = (element.tag == matcher.heading_tag and _has_class(element, matcher.heading_cls)
+                                  and _text(element).strip() == matcher.heading)
+            return None
+        if element.tag == matcher.tag and _has_class(element, matcher.cls):
+            return _text(element)
+        return None
+
+
+# Value transforms
+
+def strip(value):
+    return value.strip()
+
+def to_int(value):
+    # Remove commas from the string and convert the result to an integer
+    return int(value.strip().replace(',', ''))
+
+
+class Field:
+    # One value scraped from a page: where to find it, how to convert it and
+    # what to use when the page doesn't have it. A missing required field
+    # skips the printer.
+    def __init__(self, name, matcher, transform=None, default=None, required=False, missing=None,
+                 level=logging.WARNING):
+        self.name = name
+        self.matcher = matcher
+        self.transform = transform
+        self.default = default
+        self.required = required
+        self.missing = missing or f"{name} not found."
+        self.level = level
+
+    def value(self, raw):
+        return self.transform(raw) if self.transform else raw
+
+    def not_found(self):
+        if self.required:
+            raise LookupError(self.missing)
+        logging.log(self.level, self.missing)
+        return self.default
+
+
+# Scan one page for its fields and return {field name: value}. The page is
+# parsed by libxml2 in chunks and the scan stops once all fields are found.
+def extract(text, fields):
+    scans = {field.name: field.matcher.start() for field in fields}
+    raw = {}
+    parser = etree.HTMLPullParser(events=('end',))
+
+    def scan_events():
+        for _, element in parser.read_events():
+            for name, scan in scans.items():
+                if name not in raw:
+                    value = scan.match(element)
+                    if value is not None:
+                        raw[name] = value
+
+    for offset in range(0, len(text), CHUNK_SIZE):
+        parser.feed(text[offset:offset + CHUNK_SIZE])
+        scan_events()
+        if len(raw) == len(scans):
+            break
+    else:
+        # End of the page, flush the elements still open
+        try:
+            parser.close()
+        except etree.XMLSyntaxError:
+            pass
+        scan_events()
+
+    values = {}
+    for field in fields:
+        values[field.name] = field.value(raw[field.name]) if field.name in raw else field.not_found()
+    return values
+
+
+# Extract every page of a printer family: fields maps a page key to its
+# fields and pages maps the same keys to the page text
+def extract_pages(fields, pages):
+    values = {}
+    for key, page_fields in fields.items():
+        values.update(extract(pages[key], page_fields))
+    return values
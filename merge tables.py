@@ -1,19 +1,164 @@
+import hashlib
+import logging
+import os
+import sqlite3
+
 import pandas as pd
 
-# Read the tables from Excel files specifying the sheets
-workcenter_table = pd.read_excel("Printers inventory.xlsx", sheet_name="WorkCenter")
-printer_usage_table = pd.read_excel("Printer_Metrics.xlsx", sheet_name="Printer Daily Usage")
+from metrics_store import DB_FILE, EXCEL_FILE, open_store
+from printer_processing import usage_per_day
+from printer_registry import ip_keys
+
+INVENTORY_FILE = "Printers inventory.xlsx"
+
+# Inventory columns left out of the Workcenter Printers sheet
+DROPPED_COLUMNS = ['WorkCenter', 'Poste', 'Line ID', 'LRS name']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS inventory_source (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS workcenter_usage_state (
+    inventory_sha256 TEXT NOT NULL,
+    reading_id INTEGER NOT NULL
+);
+"""
+
+# Read the workcenter table from the inventory workbook
+def read_workcenter_table(inventory_file=INVENTORY_FILE):
+    return pd.read_excel(inventory_file, sheet_name="WorkCenter")
+
+# Workcenter table indexed by normalized IP address, without the dropped
+# columns. An IP listed twice keeps its first row.
+def workcenter_lookup(workcenter_table):
+    lookup = workcenter_table.drop(columns=DROPPED_COLUMNS, errors='ignore')
+    lookup.insert(0, 'IP Key', ip_keys(lookup.pop('IP Address')))
+    lookup = lookup[lookup['IP Key'].notna()]
+    duplicated = lookup['IP Key'].duplicated()
+    if duplicated.any():
+        logging.warning(f"IP addresses listed more than once in the inventory: "
+                        f"{', '.join(lookup.loc[duplicated, 'IP Key'])}")
+    return lookup[~duplicated].set_index('IP Key')
+
+def merge_workcenters(printer_usage_table, lookup):
+    # Add the workcenter columns of each row's printer, looked up by IP address
+    workcenters = lookup.reindex(ip_keys(printer_usage_table['IP Address']))
+    workcenters.index = printer_usage_table.index
+    return pd.concat([printer_usage_table, workcenters], axis=1)
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class WorkcenterJoin:
+    # The inventory lookup and the Workcenter Printers table, cached in the
+    # metrics database. The inventory workbook is only read again when its
+    # mtime/size and then its content hash change, and only the daily usage
+    # rows added since the last run are enriched. A different inventory than
+    # the one the table was built with re-enriches the whole history.
+    def __init__(self, path=DB_FILE, inventory_file=INVENTORY_FILE):
+        self.inventory_file = inventory_file
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.executescript(SCHEMA)
+        self.sha256 = None
+        self._lookup = None
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _table_exists(self, table):
+        return self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is not None
+
+    # The inventory lookup, from the cache while the workbook is unchanged
+    def lookup(self):
+        if self._lookup is not None:
+            return self._lookup
+        stat = os.stat(self.inventory_file)
+        source = self.conn.execute('SELECT mtime_ns, size, sha256 FROM inventory_source WHERE path = ?',
+                                   (self.inventory_file,)).fetchone()
+        cached = self._table_exists('workcenter_inventory')
+        if cached and source and source[:2] == (stat.st_mtime_ns, stat.st_size):
+            self.sha256 = source[2]
+            self._lookup = pd.read_sql_query('SELECT * FROM workcenter_inventory', self.conn).set_index('IP Key')
+            return self._lookup
+
+        self.sha256 = _sha256(self.inventory_file)
+        with self.conn:
+            if cached and source and source[2] == self.sha256:
+                # Touched but not changed
+                self._lookup = pd.read_sql_query('SELECT * FROM workcenter_inventory', self.conn).set_index('IP Key')
+            else:
+                self._lookup = workcenter_lookup(read_workcenter_table(self.inventory_file))
+                self._lookup.reset_index().to_sql('workcenter_inventory', self.conn, if_exists='replace', index=False)
+                logging.info(f"Loaded {len(self._lookup)} printers from {self.inventory_file}.")
+            self.conn.execute('INSERT OR REPLACE INTO inventory_source VALUES (?, ?, ?, ?)',
+                              (self.inventory_file, stat.st_mtime_ns, stat.st_size, self.sha256))
+        return self._lookup
+
+    # Inventory hash the workcenter_usage table was built with and the last
+    # reading ID in it
+    def _state(self):
+        return self.conn.execute('SELECT inventory_sha256, reading_id FROM workcenter_usage_state').fetchone()
+
+    def _set_state(self, reading_id):
+        self.conn.execute('DELETE FROM workcenter_usage_state')
+        self.conn.execute('INSERT INTO workcenter_usage_state VALUES (?, ?)', (self.sha256, reading_id))
+
+    # Enrich the daily usage rows added since the last run, upsert them into
+    # the workcenter_usage table and return the whole Workcenter Printers
+    # table. rebuild=True enriches the whole daily usage again.
+    def update(self, store, rebuild=False):
+        lookup = self.lookup()
+        state = self._state()
+        if rebuild or state is None or state[0] != self.sha256 or not self._table_exists('workcenter_usage'):
+            with self.conn:
+                self.conn.execute('DROP TABLE IF EXISTS workcenter_usage')
+                self.conn.execute('DELETE FROM workcenter_usage_state')
+            state = None
 
-# Merge the tables based on IP address
-merged_table = pd.merge(printer_usage_table, workcenter_table, left_on='IP Address', right_on='IP Address', how='left')
+        new_usage = store.new_daily_usage(state[1] if state else 0)
+        if not new_usage.empty:
+            enriched = merge_workcenters(new_usage, lookup)
+            with self.conn:
+                if self._table_exists('workcenter_usage'):
+                    self.conn.executemany('DELETE FROM workcenter_usage WHERE "Reading ID" = ?',
+                                          [(int(reading_id),) for reading_id in enriched['Reading ID']])
+                enriched.to_sql('workcenter_usage', self.conn, if_exists='append', index=False)
+                self._set_state(int(enriched['Reading ID'].max()))
+            logging.info(f"Added {len(enriched)} rows to the Workcenter Printers table.")
 
-# Drop unnecessary columns from the merged table
-merged_table.drop(['WorkCenter', 'Poste', 'Line ID', 'LRS name'], axis=1, inplace=True)
+        if not self._table_exists('workcenter_usage'):
+            return merge_workcenters(store.daily_usage(), lookup)
+        return self.table()
 
-# Rename the WorkCenter ID column
-merged_table.rename(columns={'WorkCenter ID': 'WorkCenter ID'}, inplace=True)
+    # The saved Workcenter Printers table, or None before the first merge
+    def table(self):
+        if not self._table_exists('workcenter_usage'):
+            return None
+        merged_table = pd.read_sql_query('SELECT * FROM workcenter_usage ORDER BY "Reading ID"', self.conn)
+        return merged_table.drop(columns='Reading ID')
 
-# Save the merged table to the same Excel file but in a different sheet
-with pd.ExcelWriter("Printer_Metrics.xlsx", engine='openpyxl', mode='a') as writer:
-    merged_table.to_excel(writer, index=False, sheet_name="Workcenter Printers")
 
+if __name__ == '__main__':
+    # Enrich the new daily usage and save the merged table to the same Excel
+    # file but in a different sheet
+    # Imported here, the pipeline imports this module
+    import printer_pipeline
+    with open_store() as store:
+        with WorkcenterJoin(store.path) as join:
+            merged_table = join.update(store)
+        printer_pipeline.export_store(store, EXCEL_FILE, {"Workcenter Printers": usage_per_day(merged_table)})
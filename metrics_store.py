@@ -0,0 +1,234 @@
+import logging
+import os
+import sqlite3
+
+import openpyxl
+import pandas as pd
+
+# SQLite database holding every printer reading, Printer_Metrics.xlsx is
+# exported from it
+DB_FILE = 'printer_metrics.db'
+EXCEL_FILE = 'Printer_Metrics.xlsx'
+
+# Columns of the printers sheet, in order
+COLUMNS = ['Printer ID', 'Date', 'Printer model', 'Printer name', 'IP Address', 'A4 page', 'A5 page']
+
+# Readings are stamped with their time, so a collector polling several times
+# a day keeps them apart. Readings from before only have the date.
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Rows converted for the streaming workbook writer at a time
+EXPORT_CHUNK = 10000
+
+# Default data for the pages table
+PAGES = [(1, 'A4', 0.07), (2, 'A5', 0.07)]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS readings (
+    reading_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    printer_id INTEGER,
+    date TEXT NOT NULL,
+    printer_model TEXT,
+    printer_name TEXT,
+    ip_address TEXT,
+    a4_page INTEGER,
+    a5_page INTEGER
+);
+CREATE INDEX IF NOT EXISTS readings_printer_date ON readings (printer_id, date);
+CREATE TABLE IF NOT EXISTS daily_usage (
+    reading_id INTEGER PRIMARY KEY,
+    printer_id INTEGER,
+    date TEXT NOT NULL,
+    printer_model TEXT,
+    printer_name TEXT,
+    ip_address TEXT,
+    a4_page INTEGER,
+    a5_page INTEGER
+);
+CREATE TABLE IF NOT EXISTS usage_state (
+    printer_id INTEGER PRIMARY KEY,
+    date TEXT,
+    a4_page INTEGER,
+    a5_page INTEGER
+);
+CREATE TABLE IF NOT EXISTS watermarks (
+    name TEXT PRIMARY KEY,
+    reading_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pages (
+    page_id INTEGER PRIMARY KEY,
+    page_size TEXT NOT NULL,
+    cost REAL NOT NULL
+);
+"""
+
+# Map the sheet column names to the table columns
+_FIELDS = {
+    'Printer ID': 'printer_id',
+    'Date': 'date',
+    'Printer model': 'printer_model',
+    'Printer name': 'printer_name',
+    'IP Address': 'ip_address',
+    'A4 page': 'a4_page',
+    'A5 page': 'a5_page',
+}
+
+
+class MetricsStore:
+    def __init__(self, path=DB_FILE):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+        self.conn.executemany('INSERT OR IGNORE INTO pages VALUES (?, ?, ?)', PAGES)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def is_empty(self):
+        return self.conn.execute('SELECT 1 FROM readings LIMIT 1').fetchone() is None
+
+    # Insert a whole run's rows (dicts keyed by the sheet column names) in one
+    # transaction and return how many were added. skip_existing leaves out rows
+    # whose printer already has a reading with the same counters on the same
+    # day, as overlapping collectors poll the same printer seconds apart.
+    def insert_readings(self, rows, skip_existing=False):
+        fields = list(_FIELDS.values())
+        values = [tuple(_to_sql(row.get(column)) for column in _FIELDS) for row in rows]
+        if skip_existing:
+            sql = (f"INSERT INTO readings ({', '.join(fields)}) SELECT {', '.join('?' * len(fields))} "
+                   "WHERE NOT EXISTS (SELECT 1 FROM readings "
+                   "WHERE printer_id IS ? AND date BETWEEN substr(?, 1, 10) AND substr(?, 1, 10) || ' 23:59:59' "
+                   "AND a4_page IS ? AND a5_page IS ?)")
+            values = [value + (value[0], value[1], value[1], value[5], value[6]) for value in values]
+        else:
+            sql = f"INSERT INTO readings ({', '.join(fields)}) VALUES ({', '.join('?' * len(fields))})"
+        changes = self.conn.total_changes
+        with self.conn:
+            self.conn.executemany(sql, values)
+        return self.conn.total_changes - changes
+
+    # Every reading as a DataFrame with the printers sheet columns
+    def readings(self):
+        return self._select('readings')
+
+    # Readings added after the given reading ID, with their 'Reading ID'
+    def new_readings(self, after):
+        return self._select('readings', 'WHERE reading_id > ?', (after,), reading_id=True)
+
+    # All readings of the given printers, with their 'Reading ID'
+    def printer_readings(self, printer_ids):
+        printer_ids = [int(printer_id) for printer_id in printer_ids]
+        chunks = [printer_ids[start:start + 500] for start in range(0, len(printer_ids), 500)]
+        frames = [self._select('readings', f'WHERE printer_id IN ({", ".join("?" * len(chunk))})', chunk,
+                               reading_id=True) for chunk in chunks]
+        return pd.concat(frames, ignore_index=True) if frames else self._select('readings', 'WHERE 0', reading_id=True)
+
+    # Last reading of every IP address
+    def latest_readings(self):
+        return self._select('readings', 'WHERE reading_id IN (SELECT MAX(reading_id) FROM readings GROUP BY ip_address)')
+
+    def daily_usage(self):
+        return self._select('daily_usage')
+
+    # Daily usage rows added after the given reading ID, with their 'Reading ID'
+    def new_daily_usage(self, after):
+        return self._select('daily_usage', 'WHERE reading_id > ?', (after,), reading_id=True)
+
+    def _select(self, table, where='', params=(), reading_id=False):
+        fields = [f'{field} AS "{column}"' for column, field in _FIELDS.items()]
+        if reading_id:
+            fields.insert(0, 'reading_id AS "Reading ID"')
+        return pd.read_sql_query(
+            f'SELECT {", ".join(fields)} FROM {table} {where} ORDER BY reading_id', self.conn, params=params)
+
+    # Last reading ID already turned into daily usage
+    def usage_watermark(self):
+        row = self.conn.execute("SELECT reading_id FROM watermarks WHERE name = 'daily_usage'").fetchone()
+        return row[0] if row else 0
+
+    # Last date and counter values seen for each printer
+    def usage_state(self):
+        return pd.read_sql_query(
+            'SELECT printer_id AS "Printer ID", date AS "Date", a4_page AS "A4 page", a5_page AS "A5 page" '
+            'FROM usage_state', self.conn)
+
+    # Append new daily usage rows and move the per-printer state and the
+    # watermark forward, all in one transaction
+    def append_daily_usage(self, daily_usage, state, watermark):
+        fields = ['reading_id'] + list(_FIELDS.values())
+        usage_rows = _records(daily_usage, ['Reading ID'] + list(_FIELDS))
+        state_rows = _records(state, ['Printer ID', 'Date', 'A4 page', 'A5 page'])
+        with self.conn:
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO daily_usage ({', '.join(fields)}) VALUES ({', '.join('?' * len(fields))})",
+                usage_rows)
+            self.conn.executemany('INSERT OR REPLACE INTO usage_state VALUES (?, ?, ?, ?)', state_rows)
+            self.conn.execute("INSERT OR REPLACE INTO watermarks VALUES ('daily_usage', ?)", (watermark,))
+
+    # Forget the daily usage so the next update recomputes it from scratch
+    def reset_daily_usage(self):
+        with self.conn:
+            self.conn.execute('DELETE FROM daily_usage')
+            self.conn.execute('DELETE FROM usage_state')
+            self.conn.execute("DELETE FROM watermarks WHERE name = 'daily_usage'")
+
+    def pages(self):
+        return pd.read_sql_query(
+            'SELECT page_id AS "Page ID", page_size AS "Page Size", cost AS "Cost" FROM pages ORDER BY page_id',
+            self.conn)
+
+    # One-time migration of an existing workbook into an empty store
+    def import_excel(self, excel_file=EXCEL_FILE, sheet_name='printers'):
+        if not self.is_empty() or not os.path.exists(excel_file):
+            return 0
+        df = pd.read_excel(excel_file, sheet_name=sheet_name)
+        df = df.reindex(columns=COLUMNS)
+        df = df.astype(object).where(df.notna(), None)
+        count = self.insert_readings(df.to_dict('records'))
+        logging.info(f"Imported {count} readings from {excel_file}.")
+        return count
+
+
+# sqlite3 can't bind numpy scalars or timestamps
+def _to_sql(value):
+    if isinstance(value, pd.Timestamp):
+        return value.strftime('%Y-%m-%d' if value == value.normalize() else TIME_FORMAT)
+    return value.item() if hasattr(value, 'item') else value
+
+
+# DataFrame rows as tuples sqlite3 can bind, missing values become NULL
+def _records(df, columns):
+    return [tuple(None if pd.isna(value) else _to_sql(value) for value in row)
+            for row in df[columns].itertuples(index=False, name=None)]
+
+
+# Write every sheet to a new workbook in one pass with openpyxl's write-only
+# (streaming) mode, then put it in place of the old workbook. Rows go straight
+# to the file, so memory doesn't grow with the number of cells, and the old
+# workbook is never loaded. Sheets not in sheets are dropped.
+def export_workbook(excel_file, sheets):
+    workbook = openpyxl.Workbook(write_only=True)
+    for sheet_name, df in sheets.items():
+        sheet = workbook.create_sheet(sheet_name)
+        sheet.append([str(column) for column in df.columns])
+        for start in range(0, len(df), EXPORT_CHUNK):
+            chunk = df.iloc[start:start + EXPORT_CHUNK].astype(object)
+            for row in chunk.where(chunk.notna(), None).itertuples(index=False, name=None):
+                sheet.append(row)
+    workbook.save(excel_file + '.tmp')
+    os.replace(excel_file + '.tmp', excel_file)
+
+
+# Open the store, importing the legacy workbook the first time
+def open_store(path=DB_FILE, excel_file=EXCEL_FILE, sheet_name='printers'):
+    store = MetricsStore(path)
+    store.import_excel(excel_file, sheet_name)
+    return store
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import logging
+import sqlite3
+from datetime import datetime, timedelta
+
+from ews_parser import extract_pages
+from metrics_store import DB_FILE
+from printer_poller import PageCache
+
+# How long the values of a printer's static pages (model, host name, network
+# settings) are reused before those pages are scraped again
+STATIC_TTL = timedelta(days=30)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS page_state (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    sha256 TEXT,
+    fetched_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS printer_static (
+    address TEXT PRIMARY KEY,
+    fields TEXT NOT NULL,
+    fetched_at TEXT NOT NULL
+);
+"""
+
+
+def _now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+class PageState:
+    # What the last stored run saw of every printer: the ETag, Last-Modified
+    # and content hash of its usage page, and the values of its static pages.
+    # Updates are kept in memory and saved once the run's readings are stored,
+    # so a failed run never hides a change from the next one.
+    def __init__(self, path=DB_FILE, static_ttl=STATIC_TTL):
+        self.static_ttl = static_ttl
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.executescript(SCHEMA)
+        self.pages = {row[0]: row for row in self.conn.execute(
+            'SELECT url, etag, last_modified, sha256, fetched_at FROM page_state')}
+        self.statics = {address: (json.loads(fields), datetime.strptime(fetched_at, '%Y-%m-%d %H:%M:%S'))
+                        for address, fields, fetched_at in self.conn.execute(
+                            'SELECT address, fields, fetched_at FROM printer_static')}
+        self.unchanged_printers = []
+        self._pages = {}
+        self._statics = {}
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # State of a page: the one seen this run when there is one, the saved
+    # one otherwise (the daemon polls a printer again before saving)
+    def _page(self, url):
+        return self._pages.get(url) or self.pages.get(url)
+
+    # Conditional request headers for a page, from the validators it sent last
+    def validators(self, url):
+        headers = {}
+        page = self._page(url)
+        if page:
+            _, etag, last_modified, _, _ = page
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        return headers
+
+    # The page is the one stored last time: 304 Not Modified, or the same bytes
+    def unchanged(self, url, response):
+        if response.status_code == 304:
+            return True
+        page = self._page(url)
+        return page is not None and page[3] == hashlib.sha256(response.content).hexdigest()
+
+    def changed(self, url, response):
+        self._pages[url] = (url, response.headers.get('ETag'), response.headers.get('Last-Modified'),
+                            hashlib.sha256(response.content).hexdigest(), _now())
+
+    # Cached static values of a printer, or None when missing or too old
+    def static(self, address):
+        if address in self._statics:
+            return json.loads(self._statics[address][1])
+        if address not in self.statics:
+            return None
+        fields, fetched_at = self.statics[address]
+        return fields if datetime.now() - fetched_at < self.static_ttl else None
+
+    def remember_static(self, address, fields):
+        self._statics[address] = (address, json.dumps(fields), _now())
+
+    # Write the run's validators and static values in one transaction
+    def save(self):
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO page_state VALUES (?, ?, ?, ?, ?)',
+                                  list(self._pages.values()))
+            self.conn.executemany('INSERT OR REPLACE INTO printer_static VALUES (?, ?, ?)',
+                                  list(self._statics.values()))
+        self.pages.update(self._pages)
+        for address, fields, fetched_at in self._statics.values():
+            self.statics[address] = (json.loads(fields), datetime.strptime(fetched_at, '%Y-%m-%d %H:%M:%S'))
+        self._pages = {}
+        self._statics = {}
+        if self.unchanged_printers:
+            logging.info(f"{len(self.unchanged_printers)} printers unchanged since the last run.")
+        self.unchanged_printers = []
+
+
+# Scrape a printer's pages (keyed like fields) and return its row. With the
+# poller's page state, only the usage page is fetched, conditionally: when it
+# hasn't changed the printer is skipped (None), and the other pages are only
+# fetched when their cached values are too old.
+async def scrape_pages(poller, ip_address, urls, fields, usage_page):
+    state = poller.page_state
+    cache = PageCache(poller)
+    if state is None:
+        pages = await cache.get_all(urls)
+        with poller.metrics.timer('parse', printer=ip_address):
+            return extract_pages(fields, pages)
+
+    usage_url = urls[usage_page]
+    response = await poller.fetch(usage_url, headers=state.validators(usage_url))
+    if state.unchanged(usage_url, response):
+        state.unchanged_printers.append(ip_address)
+        return None
+
+    static = state.static(ip_address)
+    static_pages = {} if static is not None else {key: url for key, url in urls.items() if key != usage_page}
+    pages = await cache.get_all(static_pages)
+    pages[usage_page] = response.text
+
+    with poller.metrics.timer('parse', printer=ip_address):
+        row = extract_pages({key: fields[key] for key in pages}, pages)
+    if static is None:
+        state.remember_static(ip_address, {field.name: row[field.name] for key in static_pages
+                                           for field in fields[key]})
+    else:
+        row.update(static)
+    state.changed(usage_url, response)
+    return row
@@ -0,0 +1,364 @@
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from metrics_store import open_store
+from page_state import PageState
+from printer_discovery import PrinterDiscovery, expand, read_inventory
+from printer_pipeline import FAMILIES, SCRAPERS, make_collector
+from printer_poller import FleetPoller, read_ip_addresses
+from printer_processing import COUNTER_COLUMNS
+from printer_registry import PrinterRegistry, printer_identity
+from printer_scheduler import PrinterScheduler
+from run_metrics import RunMetrics
+
+# Default poll interval of a printer, in seconds. Failing printers back off
+# exponentially up to MAX_BACKOFF.
+POLL_INTERVAL = 900
+MAX_BACKOFF = 3600
+
+# Readings are written to the store once BATCH_SIZE of them are waiting or
+# FLUSH_INTERVAL seconds after the last write
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 60
+
+# The printer lists are read again when they change, and at least this often
+# so discovery catches up with swapped printers
+RELOAD_INTERVAL = 3600
+
+# Seconds between two passes of the scheduling loop
+TICK = 1
+
+# Local endpoint the live metrics are served on
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9180
+
+
+# Poll interval overrides, one "address seconds" line per printer or CIDR range
+def read_intervals(path):
+    intervals = {}
+    with open(path, 'r') as file:
+        for line in file:
+            fields = line.split('#')[0].split()
+            if len(fields) > 1:
+                for address in expand(fields[0]):
+                    intervals[address] = float(fields[1])
+    return intervals
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _printer_id(row):
+    printer_id = row.get('Printer ID')
+    return '' if printer_id is None else int(printer_id)
+
+def _labels(**labels):
+    return '{' + ','.join(f'{name}="{_label(value)}"' for name, value in labels.items()) + '}'
+
+
+class PrinterDaemon:
+    # Resident collector: polls every printer on its own interval with one
+    # fleet poller whose keep-alive sessions stay open, keeps the registry,
+    # the printer lists, the page state and the latest counters in memory and
+    # writes the new readings to the store in batches. The workbook and the
+    # usage tables are left to the pipeline (--from deltas).
+    def __init__(self, interval=POLL_INTERVAL, intervals=None, collector='ews', inventory=None, full=False,
+                 batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, reload_interval=RELOAD_INTERVAL):
+        self.interval = interval
+        self.intervals_file = intervals
+        self.collector = collector
+        self.inventory = inventory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.reload_interval = reload_interval
+        self.store = open_store()
+        self.metrics = RunMetrics()
+        self.page_state = None if full else PageState(self.store.path)
+        self.poller = FleetPoller(metrics=self.metrics, page_state=self.page_state)
+        self.registry = PrinterRegistry(self.store.path)
+        self.scheduler = PrinterScheduler(self.store.path)
+        markers = {family: SCRAPERS[stage][1].FINGERPRINT for family, stage in FAMILIES.items()}
+        self.discovery = PrinterDiscovery(markers, self.store.path)
+        self.collectors = {stage: self.discovery.checked(self.scheduler.tracked(make_collector(scraper, collector)))
+                           for stage, (_, scraper) in SCRAPERS.items()}
+
+        # Printer address -> scrape stage, and when each is polled next
+        self.devices = {}
+        self.intervals = {}
+        self.next_poll = {}
+        self._sources = None
+        self._loaded_at = 0
+        self._polling = {}
+
+        # Latest reading of every printer, by identity, starting from the store
+        latest = self.store.latest_readings()
+        latest = latest.astype(object).where(latest.notna(), None)
+        self.latest = {printer_identity(row): row for row in latest.to_dict('records')}
+        self.pending = []
+        self.polls = {'ok': 0, 'unchanged': 0, 'skipped': 0, 'error': 0}
+        self.stored = 0
+        self.flushed_at = time.time()
+        self.started_at = time.time()
+        self.last_summary = None
+        self._stopping = None
+        self._loop = None
+
+    def close(self):
+        for resource in (self.discovery, self.scheduler, self.registry, self.page_state, self.store):
+            if resource is not None:
+                resource.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Files the fleet is read from, with their modification times
+    def _source_times(self):
+        paths = [self.inventory] if self.inventory else [ip_file for ip_file, _ in SCRAPERS.values()]
+        if self.intervals_file:
+            paths.append(self.intervals_file)
+        return {path: os.stat(path).st_mtime_ns if os.path.exists(path) else None for path in paths}
+
+    # Read the printer lists (or detect the families of the inventory) again
+    # when they changed. New printers are spread over their first interval,
+    # removed ones are dropped.
+    async def reload(self):
+        sources = self._source_times()
+        if sources == self._sources and time.monotonic() - self._loaded_at < self.reload_interval:
+            return
+        self._sources = sources
+        self._loaded_at = time.monotonic()
+
+        devices = {}
+        if self.inventory:
+            families = await self.discovery.discover_async(self.poller, read_inventory(self.inventory))
+            for family, addresses in families.items():
+                devices.update(dict.fromkeys(addresses, FAMILIES[family]))
+        else:
+            for stage, (ip_file, _) in SCRAPERS.items():
+                try:
+                    devices.update(dict.fromkeys(read_ip_addresses(ip_file), stage))
+                except FileNotFoundError:
+                    logging.error(f"Printer list {ip_file} not found, skipping {stage}.")
+        self.intervals = read_intervals(self.intervals_file) if self.intervals_file else {}
+
+        now = time.monotonic()
+        new = [address for address in devices if address not in self.next_poll]
+        for i, address in enumerate(new):
+            self.next_poll[address] = now + i * self._interval(address) / len(new)
+        for address in set(self.next_poll) - set(devices):
+            del self.next_poll[address]
+        self.devices = devices
+        logging.info(f"Polling {len(devices)} printers ({len(new)} new).")
+
+    # Seconds until a printer is polled again: its own interval, doubled for
+    # every consecutive failure up to MAX_BACKOFF
+    def _interval(self, address):
+        interval = self.intervals.get(address, self.interval)
+        health = self.scheduler.health.get(address)
+        if health and health.failures:
+            interval = min(interval * 2 ** health.failures, max(interval, MAX_BACKOFF))
+        return interval
+
+    async def _poll(self, address):
+        try:
+            row = await self.collectors[self.devices[address]](self.poller, address)
+        except Exception as e:
+            logging.error(f"An error occurred for printer at IP address {address}: {str(e)}")
+            self.polls['error'] += 1
+        else:
+            if row is not None:
+                self.polls['ok'] += 1
+                self.pending.append(row)
+                self.latest[printer_identity(row)] = row
+            elif self.scheduler.is_open(address):
+                self.polls['skipped'] += 1
+            else:
+                self.polls['unchanged'] += 1
+        finally:
+            if address in self.devices:
+                self.next_poll[address] = time.monotonic() + self._interval(address)
+            del self._polling[address]
+
+    # Write the waiting readings in one transaction, then what the page state
+    # and the scheduler learnt since the last write, and the run metrics
+    def flush(self):
+        rows, self.pending = self.pending, []
+        if rows:
+            self.registry.assign(rows)
+            with self.metrics.timer('storage', table='readings', rows=len(rows)):
+                self.stored += self.store.insert_readings(rows)
+            logging.info(f"Stored {len(rows)} readings.")
+        if self.page_state:
+            self.page_state.save()
+        self.scheduler.save()
+        self.scheduler.skipped = []
+        if self.metrics.events:
+            self.last_summary = self.metrics.write()
+            self.metrics.reset()
+        self.flushed_at = time.time()
+
+    def stop(self):
+        self._stopping.set()
+
+    # Poll the fleet until stop() (SIGINT/SIGTERM), then finish the polls in
+    # flight and write what is left
+    async def serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self._loop.add_signal_handler(signum, self.stop)
+            except (NotImplementedError, RuntimeError):
+                pass
+        self.poller.open()
+        try:
+            while not self._stopping.is_set():
+                await self.reload()
+                now = time.monotonic()
+                for address, due in list(self.next_poll.items()):
+                    if due <= now and address not in self._polling:
+                        self._polling[address] = asyncio.ensure_future(self._poll(address))
+                if len(self.pending) >= self.batch_size or time.time() - self.flushed_at >= self.flush_interval:
+                    self.flush()
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), TICK)
+                except asyncio.TimeoutError:
+                    pass
+            logging.info(f"Stopping, waiting for {len(self._polling)} polls.")
+            await asyncio.gather(*self._polling.values())
+        finally:
+            self.flush()
+            self.poller.close()
+
+    # Current counters and collector health in the Prometheus text format
+    async def _render(self):
+        lines = [
+            '# HELP printer_pages_total Page counter last read from the printer, by page size.',
+            '# TYPE printer_pages_total counter',
+        ]
+        for row in self.latest.values():
+            for column in COUNTER_COLUMNS:
+                if row.get(column) is not None:
+                    labels = _labels(address=row.get('IP Address'), name=row.get('Printer name'),
+                                     model=row.get('Printer model'), printer_id=_printer_id(row),
+                                     size=column.split()[0])
+                    lines.append(f'printer_pages_total{labels} {int(row[column])}')
+
+        health = {address: self.scheduler.health.get(address) for address in self.devices}
+        lines += ['# HELP printer_up Whether the last poll of the printer reached it.',
+                  '# TYPE printer_up gauge']
+        lines += [f'printer_up{_labels(address=address)} {int(not h or not h.failures)}'
+                  for address, h in health.items()]
+        lines += ['# HELP printer_consecutive_failures Polls in a row the printer could not be reached.',
+                  '# TYPE printer_consecutive_failures gauge']
+        lines += [f'printer_consecutive_failures{_labels(address=address)} {h.failures if h else 0}'
+                  for address, h in health.items()]
+        lines += ['# HELP printer_poll_interval_seconds Seconds between two polls of the printer.',
+                  '# TYPE printer_poll_interval_seconds gauge']
+        lines += [f'printer_poll_interval_seconds{_labels(address=address)} {self._interval(address):g}'
+                  for address in self.devices]
+
+        lines += ['# HELP collector_polls_total Printer polls by outcome.', '# TYPE collector_polls_total counter']
+        lines += [f'collector_polls_total{_labels(result=result)} {count}' for result, count in self.polls.items()]
+        open_circuits = sum(1 for address in self.devices if self.scheduler.is_open(address))
+        lines += [
+            '# HELP collector_printers Printers polled, by circuit state.', '# TYPE collector_printers gauge',
+            f'collector_printers{_labels(state="closed")} {len(self.devices) - open_circuits}',
+            f'collector_printers{_labels(state="open")} {open_circuits}',
+            '# HELP collector_readings_pending Readings waiting to be stored.',
+            '# TYPE collector_readings_pending gauge',
+            f'collector_readings_pending {len(self.pending)}',
+            '# HELP collector_readings_stored_total Readings written to the store.',
+            '# TYPE collector_readings_stored_total counter',
+            f'collector_readings_stored_total {self.stored}',
+            '# HELP collector_last_flush_timestamp_seconds When readings were last written to the store.',
+            '# TYPE collector_last_flush_timestamp_seconds gauge',
+            f'collector_last_flush_timestamp_seconds {self.flushed_at:.0f}',
+            '# HELP collector_start_time_seconds When the collector started.',
+            '# TYPE collector_start_time_seconds gauge',
+            f'collector_start_time_seconds {self.started_at:.0f}',
+        ]
+        if self.last_summary and self.last_summary['fetch_p50'] is not None:
+            lines += ['# HELP collector_fetch_seconds Page fetch latency between the last two writes.',
+                      '# TYPE collector_fetch_seconds gauge',
+                      f'collector_fetch_seconds{_labels(quantile="0.5")} {self.last_summary["fetch_p50"]}',
+                      f'collector_fetch_seconds{_labels(quantile="0.95")} {self.last_summary["fetch_p95"]}']
+        return '\n'.join(lines) + '\n'
+
+    # The metrics page, rendered on the event loop so it never sees the state
+    # half updated. Called from the HTTP server's threads.
+    def render_metrics(self, timeout=10):
+        if self._loop is None or not self._loop.is_running():
+            raise RuntimeError('The collector is not running')
+        return asyncio.run_coroutine_threadsafe(self._render(), self._loop).result(timeout)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        try:
+            body = self.server.printer_daemon.render_metrics().encode()
+        except RuntimeError as e:
+            self.send_error(503, str(e))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Serve the daemon's /metrics page from a background thread, return the server
+def serve_metrics(daemon, host=METRICS_HOST, port=METRICS_PORT):
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    server.printer_daemon = daemon
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Printer metrics collector daemon')
+    parser.add_argument('--interval', type=float, default=POLL_INTERVAL, help='seconds between two polls of a printer')
+    parser.add_argument('--intervals', help='file of "address seconds" lines overriding the interval per printer')
+    parser.add_argument('--collector', choices=['ews', 'snmp'], default='ews',
+                        help='poll printers over SNMP (falling back to HTTP) or scrape the EWS pages')
+    parser.add_argument('--inventory', help='file of printer addresses and CIDR ranges; the model of each '
+                                            'printer is detected instead of read from the per-model IP lists')
+    parser.add_argument('--full', action='store_true',
+                        help='scrape every page of every printer, even when its usage page is unchanged')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='readings stored per write at most')
+    parser.add_argument('--flush-interval', type=float, default=FLUSH_INTERVAL,
+                        help='seconds between two writes to the store')
+    parser.add_argument('--host', default=METRICS_HOST, help='address the metrics endpoint listens on')
+    parser.add_argument('--port', type=int, default=METRICS_PORT, help='port of the metrics endpoint, 0 to disable')
+    args = parser.parse_args(argv)
+
+    with PrinterDaemon(args.interval, args.intervals, args.collector, args.inventory, args.full,
+                       args.batch_size, args.flush_interval) as daemon:
+        server = serve_metrics(daemon, args.host, args.port) if args.port else None
+        try:
+            asyncio.run(daemon.serve())
+        finally:
+            if server:
+                server.shutdown()
+                server.server_close()
+
+
+if __name__ == '__main__':
+    main()
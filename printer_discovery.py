@@ -0,0 +1,162 @@
+import asyncio
+import ipaddress
+import logging
+import sqlite3
+from datetime import datetime, timedelta
+
+import requests
+
+from metrics_store import DB_FILE
+
+# How long a detected model family is trusted before the printer is
+# fingerprinted again, and how long an address without a known EWS is left
+# alone before it is scanned again
+FAMILY_TTL = timedelta(days=7)
+UNKNOWN_TTL = timedelta(days=1)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS printer_family (
+    address TEXT PRIMARY KEY,
+    family TEXT,
+    detected_at TEXT NOT NULL
+);
+"""
+
+
+# Addresses of one inventory line: a printer address (host or host:port) or a
+# CIDR range, optionally followed by the port every host of the range uses
+# (10.1.2.0/24 or 10.1.2.0/24:8080)
+def expand(entry):
+    if '/' not in entry:
+        return [entry]
+    network, _, port = entry.partition(':')
+    suffix = f':{port}' if port else ''
+    return [f'{host}{suffix}' for host in ipaddress.ip_network(network, strict=False).hosts()]
+
+
+# Every address of an inventory file, in order and without duplicates. Blank
+# lines and # comments are skipped, a site tag may follow the address.
+def read_inventory(path):
+    addresses = []
+    with open(path, 'r') as file:
+        for line in file:
+            fields = line.split('#')[0].split()
+            if fields:
+                addresses.extend(expand(fields[0]))
+    return list(dict.fromkeys(addresses))
+
+
+# Model family whose marker shows up in the home page (its final URL or its
+# text), or None
+def fingerprint(response, markers):
+    haystack = response.url + response.text
+    for family, marker in markers.items():
+        if marker in haystack:
+            return family
+    return None
+
+
+class PrinterDiscovery:
+    # Detects the model family of every inventory address with one GET of its
+    # EWS home page and remembers it in the metrics database, so most runs
+    # don't fingerprint anything. markers maps a family to the string its
+    # home page gives away.
+    def __init__(self, markers, path=DB_FILE, ttl=FAMILY_TTL, unknown_ttl=UNKNOWN_TTL):
+        self.markers = markers
+        self.ttl = ttl
+        self.unknown_ttl = unknown_ttl
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.executescript(SCHEMA)
+        self.families = {}
+        self.detected_at = {}
+        for address, family, detected_at in self.conn.execute(
+                'SELECT address, family, detected_at FROM printer_family'):
+            self.families[address] = family
+            self.detected_at[address] = datetime.strptime(detected_at, '%Y-%m-%d %H:%M:%S')
+        self._changed = set()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _fresh(self, address):
+        if address not in self.families:
+            return False
+        ttl = self.ttl if self.families[address] else self.unknown_ttl
+        return datetime.now() - self.detected_at[address] < ttl
+
+    def _remember(self, address, family):
+        self.families[address] = family
+        self.detected_at[address] = datetime.now().replace(microsecond=0)
+        self._changed.add(address)
+
+    # Fingerprint one address on the fleet poller
+    async def _detect(self, poller, address):
+        response = await poller.probe(address)
+        family = fingerprint(response, self.markers) if response is not None else None
+        self._remember(address, family)
+        return family
+
+    # Group the addresses by model family ({family: [addresses]}), detecting
+    # the ones not cached or cached too long ago concurrently. Addresses that
+    # don't answer or aren't a known printer are left out.
+    def discover(self, poller, addresses):
+        stale = [address for address in addresses if not self._fresh(address)]
+        if stale:
+            poller.run(stale, self._detect)
+            self.save()
+        return self._groups(addresses, stale)
+
+    # discover() on a poller already open on the running event loop (the
+    # daemon's)
+    async def discover_async(self, poller, addresses):
+        stale = [address for address in addresses if not self._fresh(address)]
+        if stale:
+            await asyncio.gather(*(poller.poll(address, self._detect) for address in stale))
+            self.save()
+        return self._groups(addresses, stale)
+
+    def _groups(self, addresses, stale):
+        groups = {family: [] for family in self.markers}
+        for address in addresses:
+            family = self.families.get(address)
+            if family in groups:
+                groups[family].append(address)
+        found = sum(len(group) for group in groups.values())
+        logging.info(f"Discovered {found} printers out of {len(addresses)} addresses "
+                     f"({len(stale)} fingerprinted): "
+                     + ', '.join(f"{len(group)} {family}" for family, group in groups.items()))
+        return groups
+
+    # Drop the cached family of an address, it is fingerprinted again next run
+    def forget(self, address):
+        if self.families.pop(address, None) is not None:
+            self.conn.execute('DELETE FROM printer_family WHERE address = ?', (address,))
+            self.conn.commit()
+            logging.info(f"Model family of {address} is out of date, it will be detected again.")
+
+    # Wrap a family's collector: a 404 from a printer means it isn't the
+    # model it was cached as (it was swapped), so its family is forgotten
+    def checked(self, collector):
+        async def poll(poller, ip_address):
+            try:
+                return await collector(poller, ip_address)
+            except requests.HTTPError as e:
+                if e.response is not None and e.response.status_code == 404:
+                    self.forget(ip_address)
+                raise
+        return poll
+
+    # Write the families detected this run in one transaction
+    def save(self):
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO printer_family VALUES (?, ?, ?)',
+                [(address, self.families[address], self.detected_at[address].strftime('%Y-%m-%d %H:%M:%S'))
+                 for address in self._changed if address in self.families])
+        self._changed = set()
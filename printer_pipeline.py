@@ -0,0 +1,312 @@
+import argparse
+import importlib.util
+import logging
+import os
+import sys
+
+import HP_Printer_Scrape as futuresmart
+import printer_processing
+from collectors import EwsCollector, SnmpCollector
+from metrics_store import EXCEL_FILE, export_workbook, open_store
+from page_state import PageState
+from printer_discovery import PrinterDiscovery, read_inventory
+from printer_poller import FleetPoller, read_ip_addresses
+from printer_registry import PrinterRegistry
+from printer_scheduler import PrinterScheduler
+from run_metrics import RunMetrics
+from sharding import PARTIALS_DIR, Shard, merge_partials, read_sites, write_partial
+from usage_history import UsageHistory
+
+
+# The M501dn scraper and the merge script have spaces in their file names, so
+# load them by path
+def _load_script(module_name, file_name):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), file_name)
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+m501dn = _load_script('m501dn_scrape', 'HP M501dn_Printer_Scrape.py')
+merge_tables = _load_script('merge_tables', 'merge tables.py')
+
+# Pipeline stages, in order
+STAGES = ['scrape-futuresmart', 'scrape-m501dn', 'collect', 'deltas', 'history', 'usage', 'merge']
+
+# Printer list and scraper module of each model family
+SCRAPERS = {
+    'scrape-futuresmart': ('IP Address.txt', futuresmart),
+    'scrape-m501dn': ('M501dn.txt', m501dn),
+}
+
+# Scrape stage of each model family discovery can detect
+FAMILIES = {
+    'futuresmart': 'scrape-futuresmart',
+    'm501dn': 'scrape-m501dn',
+}
+
+COLLECTORS = ['ews', 'snmp']
+
+
+# Collector for a model family: its EWS scraper, or SNMP with the EWS scraper
+# as the fallback
+def make_collector(scraper, kind='ews'):
+    if kind == 'snmp':
+        return SnmpCollector(scraper.SNMP_FIELDS, getattr(scraper, 'SNMP_DEFAULTS', None),
+                             fallback=EwsCollector(scraper.poll_printer))
+    return EwsCollector(scraper.poll_printer)
+
+
+class PipelineRun:
+    # State handed from one stage to the next. Every table a stage produces is
+    # kept in memory and becomes a workbook sheet at the end of the run.
+    def __init__(self, excel_file=EXCEL_FILE, sheet_name='printers', rebuild=False, collector='ews', window=0,
+                 inventory=None, full=False, shard=None, partials=None):
+        self.excel_file = excel_file
+        self.sheet_name = sheet_name
+        self.rebuild = rebuild
+        self.collector = collector
+        self.window = window
+        self.inventory = inventory
+        self.full = full
+        self.shard = shard
+        self.partials = partials
+        self.store = open_store(excel_file=excel_file, sheet_name=sheet_name)
+        self.metrics = RunMetrics()
+        self.sheets = {}
+
+    # Daily usage sheet: built earlier in this run, or read back from the
+    # store when the run starts after the deltas stage
+    def daily_usage(self):
+        if 'Printer Daily Usage' not in self.sheets:
+            self.sheets['Printer Daily Usage'] = printer_processing.usage_per_day(self.store.daily_usage())
+        return self.sheets['Printer Daily Usage']
+
+    def close(self):
+        self.store.close()
+
+
+# Printer addresses of each scrape stage: from the family's IP list, or
+# detected from a single inventory of addresses and CIDR ranges. A sharded run
+# keeps only its slice.
+def fleet_addresses(run, stages, poller, discovery):
+    if run.inventory:
+        addresses = read_inventory(run.inventory)
+        if run.shard:
+            addresses = run.shard.select(addresses, read_sites(run.inventory))
+        with run.metrics.timer('stage', stage='discover'):
+            families = discovery.discover(poller, addresses)
+        return {FAMILIES[family]: addresses for family, addresses in families.items() if FAMILIES[family] in stages}
+
+    addresses = {}
+    for stage in stages:
+        ip_file, _ = SCRAPERS[stage]
+        try:
+            addresses[stage] = read_ip_addresses(ip_file)
+        except FileNotFoundError:
+            logging.error(f"Printer list {ip_file} not found, skipping {stage}.")
+            continue
+        if run.shard:
+            addresses[stage] = run.shard.select(addresses[stage], read_sites(ip_file))
+    return addresses
+
+# Scrape the model families in the run at the same time on one fleet poller.
+# The scheduler skips printers whose circuit is open and retries transient
+# failures once at the end. Printers whose usage page hasn't changed since the
+# last run are skipped unless the run is a full one. A sharded run writes its
+# rows to a partial result file for the collect stage instead of the store.
+def scrape(run, stages):
+    page_state = None if run.full else PageState(run.store.path)
+    poller = FleetPoller(metrics=run.metrics, page_state=page_state)
+    markers = {family: SCRAPERS[stage][1].FINGERPRINT for family, stage in FAMILIES.items()}
+    with PrinterDiscovery(markers, run.store.path) as discovery, \
+            PrinterScheduler(run.store.path, window=run.window) as scheduler:
+        fleets = {
+            stage: (ip_addresses, discovery.checked(make_collector(SCRAPERS[stage][1], run.collector)))
+            for stage, ip_addresses in fleet_addresses(run, stages, poller, discovery).items()
+        }
+        results = scheduler.run(poller, fleets)
+    rows = [row for stage in fleets for row in results[stage]]
+
+    if run.shard:
+        write_partial(rows, run.shard, run.partials or PARTIALS_DIR)
+        if page_state:
+            page_state.save()
+            page_state.close()
+        logging.info(f"Scraped {len(rows)} printers for shard {run.shard.label}.")
+        return
+
+    with PrinterRegistry(run.store.path) as registry:
+        # Get or assign the printer ID of every printer
+        registry.assign(rows)
+    with run.metrics.timer('storage', table='readings', rows=len(rows)):
+        run.store.insert_readings(rows)
+    if page_state:
+        # The readings are stored, the next run can compare against this one
+        page_state.save()
+        page_state.close()
+    run.sheets[run.sheet_name] = run.store.readings()
+    run.sheets['pages'] = run.store.pages()
+    logging.info(f"Scraped {len(rows)} printers.")
+
+# Merge the partial result files of the sharded collectors into the store
+def collect(run):
+    if not run.partials:
+        return
+    merge_partials(run.store, run.partials)
+    run.sheets[run.sheet_name] = run.store.readings()
+    run.sheets['pages'] = run.store.pages()
+
+def compute_deltas(run):
+    printer_processing.update_daily_usage(run.store, rebuild=run.rebuild)
+    run.sheets['Printer Daily Usage'] = printer_processing.usage_per_day(run.store.daily_usage())
+
+# Append the new daily usage to the Parquet history and its rollups. A rebuild
+# of the daily usage rebuilds them too.
+def update_history(run):
+    try:
+        with merge_tables.WorkcenterJoin(run.store.path) as join:
+            workcenters = join.lookup()
+    except FileNotFoundError:
+        logging.warning(f"{merge_tables.INVENTORY_FILE} not found, usage history has no workcenters.")
+        workcenters = None
+    history = UsageHistory()
+    if run.rebuild:
+        history.reset()
+    history.update(run.store, workcenters)
+
+def build_usage(run):
+    run.sheets['Printer Usage'] = printer_processing.create_printer_usage_table(run.daily_usage())
+
+# Enrich the new daily usage with the cached inventory
+def merge_workcenters(run):
+    with merge_tables.WorkcenterJoin(run.store.path) as join:
+        try:
+            merged_table = join.update(run.store, rebuild=run.rebuild)
+            run.sheets['Workcenter Printers'] = printer_processing.usage_per_day(merged_table)
+        except FileNotFoundError:
+            logging.warning(f"{merge_tables.INVENTORY_FILE} not found, skipping the Workcenter Printers sheet.")
+
+STEPS = {
+    'collect': collect,
+    'deltas': compute_deltas,
+    'history': update_history,
+    'usage': build_usage,
+    'merge': merge_workcenters,
+}
+
+
+# Every sheet of the workbook: the ones already built (built maps a sheet name
+# to its table), the others from the store, so the workbook can be written
+# from scratch in one pass
+def workbook_sheets(store, built, sheet_name='printers'):
+    sheets = {
+        sheet_name: built[sheet_name] if sheet_name in built else store.readings(),
+        'pages': built['pages'] if 'pages' in built else store.pages(),
+    }
+    if 'Printer Daily Usage' in built:
+        sheets['Printer Daily Usage'] = built['Printer Daily Usage']
+    else:
+        sheets['Printer Daily Usage'] = printer_processing.usage_per_day(store.daily_usage())
+    if 'Printer Usage' in built:
+        sheets['Printer Usage'] = built['Printer Usage']
+    else:
+        sheets['Printer Usage'] = printer_processing.create_printer_usage_table(sheets['Printer Daily Usage'])
+    if 'Workcenter Printers' in built:
+        sheets['Workcenter Printers'] = built['Workcenter Printers']
+    else:
+        with merge_tables.WorkcenterJoin(store.path) as join:
+            merged_table = join.table()
+        if merged_table is not None:
+            sheets['Workcenter Printers'] = printer_processing.usage_per_day(merged_table)
+    return sheets
+
+# Write the whole workbook from the store with the streaming export. This is
+# the only workbook writer: the pipeline and the standalone scripts all go
+# through it, passing the sheets they built.
+def export_store(store, excel_file=EXCEL_FILE, built=None, sheet_name='printers'):
+    sheets = workbook_sheets(store, built or {}, sheet_name)
+    export_workbook(excel_file, sheets)
+    logging.info(f"Wrote {', '.join(sheets)} to {excel_file}.")
+    return sheets
+
+
+# Run the stages from first to last (inclusive) in one process and write the
+# workbook once at the end. A sharded run (shard is a Shard) only scrapes.
+def run_pipeline(first=STAGES[0], last=STAGES[-1], excel_file=EXCEL_FILE, sheet_name='printers', rebuild=False,
+                 collector='ews', window=0, inventory=None, full=False, shard=None, partials=None):
+    stages = STAGES[STAGES.index(first):STAGES.index(last) + 1]
+    if shard:
+        stages = [stage for stage in stages if stage in SCRAPERS]
+    logging.info(f"Running pipeline stages: {', '.join(stages)}")
+    run = PipelineRun(excel_file, sheet_name, rebuild, collector, window, inventory, full, shard, partials)
+    try:
+        scrapes = [stage for stage in stages if stage in SCRAPERS]
+        if scrapes:
+            with run.metrics.timer('stage', stage='scrape'):
+                scrape(run, scrapes)
+
+        # A failed stage skips the ones after it, which build on it, but the
+        # sheets built so far are still exported
+        failed = None
+        for stage in stages:
+            if stage in STEPS:
+                try:
+                    with run.metrics.timer('stage', stage=stage):
+                        STEPS[stage](run)
+                except Exception as e:
+                    logging.error(f"Stage {stage} failed, skipping the stages after it: {str(e)}")
+                    failed = e
+                    break
+
+        if not shard:
+            with run.metrics.timer('stage', stage='export'), run.metrics.timer('storage', table='workbook'):
+                export_store(run.store, excel_file, run.sheets, sheet_name)
+        if failed:
+            raise failed
+    finally:
+        run.metrics.write()
+        run.close()
+    return run.sheets
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Printer metrics pipeline')
+    parser.add_argument('excel_file', nargs='?', default=EXCEL_FILE)
+    parser.add_argument('sheet', nargs='?', default='printers')
+    parser.add_argument('--stage', choices=STAGES, help='run only this stage')
+    parser.add_argument('--from', dest='first', choices=STAGES, default=STAGES[0], help='first stage to run')
+    parser.add_argument('--to', dest='last', choices=STAGES, default=STAGES[-1], help='last stage to run')
+    parser.add_argument('--rebuild', action='store_true', help='recompute the daily usage from the whole history')
+    parser.add_argument('--collector', choices=COLLECTORS, default='ews',
+                        help='poll printers over SNMP (falling back to HTTP) or scrape the EWS pages')
+    parser.add_argument('--window', type=float, default=0,
+                        help='seconds to spread the printers\' first requests over')
+    parser.add_argument('--inventory', help='file of printer addresses and CIDR ranges; the model of each '
+                                            'printer is detected instead of read from the per-model IP lists')
+    parser.add_argument('--full', action='store_true',
+                        help='scrape every page of every printer, even when its usage page is unchanged')
+    parser.add_argument('--shard', help='poll only this slice of the printers, i/n or a site tag, and write a '
+                                        'partial result file instead of the workbook')
+    parser.add_argument('--partials', help=f'directory of partial result files, written by --shard runs and '
+                                           f'merged by the collect stage (default {PARTIALS_DIR} for --shard)')
+    args = parser.parse_args(argv)
+
+    first, last = (args.stage, args.stage) if args.stage else (args.first, args.last)
+    if STAGES.index(first) > STAGES.index(last):
+        parser.error(f'stage {first} comes after {last}')
+    try:
+        shard = Shard(args.shard) if args.shard else None
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        run_pipeline(first, last, args.excel_file, args.sheet, rebuild=args.rebuild, collector=args.collector,
+                     window=args.window, inventory=args.inventory, full=args.full, shard=shard,
+                     partials=args.partials)
+    except Exception as e:
+        logging.error(f"An error occurred: {str(e)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.util.retry import Retry
+
+from run_metrics import RunMetrics
+
+# Default limits for the fleet poller
+MAX_CONCURRENCY = 64       # Printers/requests in flight across the whole fleet
+PER_HOST_LIMIT = 2         # Connections per printer, the EWS servers are fragile
+CONNECT_TIMEOUT = 5        # Seconds to open the TCP connection
+READ_TIMEOUT = 30          # Seconds to wait for the page once connected
+RETRIES = 2                # Retries after a refused/reset connection
+BACKOFF = 0.5              # Seconds, doubled on every retry
+PROBE_TIMEOUT = 2          # Seconds a liveness probe may take, no retries
+
+
+# Retries refused and reset connections but not read timeouts: a printer that
+# accepted the connection and hangs would only cost the read timeout again
+class ConnectionRetry(Retry):
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if isinstance(error, ReadTimeoutError):
+            raise error.with_traceback(_stacktrace)
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+# Keep-alive session for one printer: at most per_host pooled connections,
+# connection errors and resets retried with exponential backoff
+def printer_session(per_host=PER_HOST_LIMIT, retries=RETRIES, backoff=BACKOFF):
+    session = requests.Session()
+    retry = ConnectionRetry(total=retries, connect=retries, read=retries, status=0, redirect=3,
+                  backoff_factor=backoff, allowed_methods=['GET', 'HEAD'])
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=per_host, pool_block=True, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# Requests sent and connections opened by a session's pools
+def session_stats(session):
+    requests_sent = opened = 0
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            requests_sent += pool.num_requests
+            opened += pool.num_connections
+    return requests_sent, opened
+
+
+class FleetPoller:
+    # Runs one coroutine per printer and throttles every page fetch through a
+    # per-host semaphore and a global semaphore. Each printer gets its own
+    # keep-alive session, so its pages share one or two TCP connections.
+    # page_state (a PageState) lets the scrapers skip printers whose pages
+    # haven't changed since the last run.
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, per_host=PER_HOST_LIMIT,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 retries=RETRIES, backoff=BACKOFF, metrics=None, page_state=None):
+        self.max_concurrency = max_concurrency
+        self.per_host = per_host
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.metrics = metrics or RunMetrics(path=None)
+        self.page_state = page_state
+        self.pool_stats = {'requests': 0, 'opened': 0, 'reused': 0}
+        self._global = None
+        self._hosts = {}
+        self._sessions = {}
+        self._closers = []
+        self._executor = None
+
+    def _host_limit(self, host):
+        if host not in self._hosts:
+            self._hosts[host] = asyncio.Semaphore(self.per_host)
+        return self._hosts[host]
+
+    def _session(self, host):
+        if host not in self._sessions:
+            self._sessions[host] = printer_session(self.per_host, self.retries, self.backoff)
+        return self._sessions[host]
+
+    # Fetch a page and return the response, raising for HTTP errors just like
+    # the old accessibility check did. Every fetch is timed in the run metrics.
+    async def fetch(self, url, headers=None):
+        host = urlsplit(url).netloc
+        session = self._session(host)
+        async with self._host_limit(host), self._global:
+            with self.metrics.timer('fetch', printer=host, url=url) as event:
+                loop = asyncio.get_running_loop()
+                response = await loop.run_in_executor(
+                    self._executor, lambda: session.get(url, headers=headers, timeout=self.timeout))
+                event['status'] = response.status_code
+                event['bytes'] = len(response.content)
+                response.raise_for_status()
+        return response
+
+    # One cheap GET of the printer's root page with a short timeout and no
+    # retries. Returns the response, whatever its status, or None when the
+    # printer didn't answer.
+    async def probe(self, ip_address, timeout=PROBE_TIMEOUT):
+        url = f'http://{ip_address}/'
+        async with self._host_limit(ip_address), self._global:
+            with self.metrics.timer('probe', printer=ip_address, url=url) as event:
+                loop = asyncio.get_running_loop()
+                try:
+                    response = await loop.run_in_executor(
+                        self._executor, lambda: requests.get(url, timeout=timeout))
+                except requests.RequestException as e:
+                    event['error'] = str(e)
+                    return None
+                event['status'] = response.status_code
+        return response
+
+    # Call fn() when the current run ends, still inside its event loop
+    def on_close(self, fn):
+        self._closers.append(fn)
+
+    # Set up the limits and worker threads on the running event loop. run()
+    # does it for every run; the daemon opens the poller once and its printer
+    # sessions stay open until close().
+    def open(self):
+        self._global = asyncio.Semaphore(self.max_concurrency)
+        self._hosts = {}
+        # requests is blocking, so every fetch holds a worker thread
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+
+    def close(self):
+        try:
+            self._executor.shutdown()
+        finally:
+            for fn in self._closers:
+                fn()
+            self._closers = []
+            self._close_sessions()
+
+    # Close every printer session and log how many connections were reused
+    def _close_sessions(self):
+        requests_sent = opened = 0
+        for session in self._sessions.values():
+            sent, new = session_stats(session)
+            requests_sent += sent
+            opened += new
+            session.close()
+        self._sessions = {}
+        self.pool_stats = {'requests': requests_sent, 'opened': opened, 'reused': max(requests_sent - opened, 0)}
+        logging.info(f"Connection pools: {requests_sent} requests, {opened} connections opened, "
+                     f"{self.pool_stats['reused']} reused.")
+
+    # Poll one printer, logging its error and returning None when it fails
+    async def poll(self, ip_address, poll_printer):
+        try:
+            return await poll_printer(self, ip_address)
+        except Exception as e:
+            logging.error(f"An error occurred for printer at IP address {ip_address}: {str(e)}")
+            return None
+
+    async def _run(self, fleets):
+        self.open()
+        try:
+            runs = {
+                name: asyncio.gather(*(self.poll(ip_address, poll_printer) for ip_address in ip_addresses))
+                for name, (ip_addresses, poll_printer) in fleets.items()
+            }
+            results = await asyncio.gather(*runs.values())
+        finally:
+            self.close()
+        return {
+            name: [result for result in fleet_results if result is not None]
+            for name, fleet_results in zip(runs, results)
+        }
+
+    # Poll every IP address with poll_printer(poller, ip_address) and return the
+    # non-empty results in the order of ip_addresses.
+    def run(self, ip_addresses, poll_printer):
+        return self.run_many({None: (ip_addresses, poll_printer)})[None]
+
+    # Poll several fleets at once under the same limits, fleets maps a name to
+    # (ip_addresses, poll_printer) and the results come back under that name.
+    def run_many(self, fleets):
+        return asyncio.run(self._run(fleets))
+
+
+# Per-printer page cache: every URL is fetched once and its text is shared by
+# all the extractors that read it. Create one per printer and let it go when
+# the printer is done.
+class PageCache:
+    def __init__(self, poller):
+        self.poller = poller
+        self._pages = {}
+
+    async def _load(self, url):
+        response = await self.poller.fetch(url)
+        return response.text
+
+    async def get(self, url):
+        if url not in self._pages:
+            self._pages[url] = asyncio.ensure_future(self._load(url))
+        return await self._pages[url]
+
+    # Fetch several pages at once, keyed like urls
+    async def get_all(self, urls):
+        pages = await asyncio.gather(*(self.get(url) for url in urls.values()))
+        return dict(zip(urls, pages))
+
+
+# Read a printer list file, skipping blank lines. A line may carry a site tag
+# after the address.
+def read_ip_addresses(path):
+    with open(path, 'r') as file:
+        return [line.split()[0] for line in file.read().splitlines() if line.strip()]
@@ -1,89 +1,139 @@
-import openpyxl
+import argparse
 
-def calculate_difference(excel_file, sheet_name):
-    try:
-        # Load the workbook
-        wb = openpyxl.load_workbook(excel_file)
-        
-        # Select the worksheet
-        sheet = wb[sheet_name]
-        
-        # Create a new worksheet for differences
-        diff_sheet = wb.create_sheet(title="Printer Daily Usage")
-        
-        # Copy the original data to the differences sheet
-        for row in sheet.iter_rows(values_only=True):
-            diff_sheet.append(row)
-        
-        # Dictionary to store the previous row for each printer ID
-        prev_rows = {}
-        
-        # Iterate over rows starting from the second row (assuming headers are in the first row)
-        for index, row in enumerate(diff_sheet.iter_rows(min_row=2, values_only=True), start=2):
-            printer_id = row[0]  # Assuming printer ID is in the first column
-            
-            # If printer ID is not already in the dictionary, add it with the current row
-            if printer_id not in prev_rows:
-                prev_rows[printer_id] = row
-            else:
-                # Calculate the differences from the previous row
-                for i, col in enumerate(["F", "G"], start=5):  
-                    try:
-                        current_value = int(row[i])
-                        prev_row_value = int(prev_rows[printer_id][i])
-                        difference = current_value - prev_row_value
-                        # Append current value if it's less than previous row's value
-                        if current_value < prev_row_value:
-                            diff_sheet[f"{col}{index}"] = current_value
-                        else:
-                            diff_sheet[f"{col}{index}"] = difference
-                    except (TypeError, ValueError):
-                        continue
-            # Store the current row as the previous row for the next iteration
-            prev_rows[printer_id] = row
-        
-        # Save the workbook
-        wb.save(excel_file)
-        print("Differences calculated and saved in Printer Daily Usage sheet.")
-    
-    except Exception as e:
-        print(f"Error occurred: {e}")
+import pandas as pd
 
-def create_printer_usage_table(excel_file):
-    try:
-        # Load the workbook
-        wb = openpyxl.load_workbook(excel_file)
-        
-        # Select the worksheet containing printer daily usage data
-        daily_usage_sheet = wb["Printer Daily Usage"]
-        
-        # Create a new worksheet for the printer usage table
-        usage_sheet = wb.create_sheet(title="Printer Usage")
-        
-        # Add headers to the usage sheet
-        usage_sheet.append(["Printer ID", "Page ID", "Page Count"])
-        
-        # Iterate over rows starting from the second row (assuming headers are in the first row)
-        for row in daily_usage_sheet.iter_rows(min_row=2, values_only=True):
-            printer_id, _, _, _, _, a4_page, a5_page = row
-            
-            # Check if both A4 page and A5 page are not empty
-            if a4_page is not None and a5_page is not None:
-                # Append data to the usage sheet with page ID 1 for A4 and page ID 2 for A5
-                usage_sheet.append([printer_id, 1, a4_page])
-                usage_sheet.append([printer_id, 2, a5_page])
-        
-        # Save the workbook
-        wb.save(excel_file)
-        print("Printer usage table created in the Printer Usage sheet.")
-    
-    except Exception as e:
-        print(f"Error occurred: {e}")
+from metrics_store import EXCEL_FILE, open_store
+
+# Page counter columns turned into daily usage
+COUNTER_COLUMNS = ['A4 page', 'A5 page']
+
+# Reading times of a Date column, whether it holds timestamps or, for older
+# readings, only dates
+def reading_times(dates):
+    return pd.to_datetime(dates, format='ISO8601', errors='coerce')
+
+def calculate_difference(printers_df):
+    daily_usage = printers_df.reset_index(drop=True)
+
+    # Walk every printer's readings in date order, rows with the same date keep
+    # the order they were scraped in
+    dates = reading_times(daily_usage['Date'])
+    order = dates.sort_values(kind='stable').index
+    ordered = daily_usage.loc[order, ['Printer ID'] + COUNTER_COLUMNS]
+    printers = ordered.groupby('Printer ID', dropna=False, sort=False)
+    previous_rows = printers[COUNTER_COLUMNS].shift()
+
+    for col in COUNTER_COLUMNS:
+        current = pd.to_numeric(ordered[col], errors='coerce')
+        previous = pd.to_numeric(previous_rows[col], errors='coerce')
+        # Keep the current value if it's less than previous row's value (the
+        # counter was reset), otherwise take the difference
+        difference = (current - previous).where(current >= previous, current)
+        # The first reading of a printer and non-numeric values stay as they are
+        has_previous = (current.notna() & previous.notna()).sort_index()
+        difference = difference.where(has_previous, 0).astype('int64').sort_index()
+        daily_usage[col] = daily_usage[col].mask(has_previous, difference)
+
+    print("Differences calculated for the Printer Daily Usage table.")
+    return daily_usage
 
+# Turn the readings added since the last run into daily usage rows and append
+# them to the store. Each printer's previous counters come from the saved
+# usage state, so only the new readings are processed, apart from printers
+# that got a reading dated before their state. rebuild=True drops the saved
+# usage and recomputes it from the whole history.
+def update_daily_usage(store, rebuild=False):
+    if rebuild:
+        store.reset_daily_usage()
+        print("Rebuilding the Printer Daily Usage table from scratch.")
 
-# Example usage
-excel_file = "Printer_Metrics.xlsx"
-sheet_name = "printers"
+    readings = store.new_readings(store.usage_watermark())
+    if readings.empty:
+        print("No new readings for the Printer Daily Usage table.")
+        return 0
 
-calculate_difference(excel_file, sheet_name)
-create_printer_usage_table(excel_file)
+    # A reading dated before its printer's last known reading (a late shard
+    # partial, say) changes the usage of every later reading of that printer,
+    # so those printers are recomputed from their whole history
+    state = store.usage_state()
+    known = state.set_index('Printer ID')['Date']
+    known_dates = reading_times(readings['Printer ID'].map(known))
+    late = readings['Printer ID'][reading_times(readings['Date']) < known_dates].dropna().unique()
+    history = store.printer_readings(late)
+    recomputed = calculate_difference(history)
+
+    # Put each other printer's last known reading in front of its new ones so
+    # the first new reading is diffed against it, then drop it again
+    state = state[~state['Printer ID'].isin(late)]
+    readings_on_time = readings[~readings['Printer ID'].isin(late)]
+    seeded = pd.concat([state.assign(**{'Reading ID': 0}), readings_on_time], ignore_index=True)
+    daily_usage = pd.concat([calculate_difference(seeded).iloc[len(state):], recomputed], ignore_index=True)
+
+    # The latest reading of every printer becomes its new state, the
+    # recomputed printers take theirs from the whole history
+    candidates = pd.concat([readings_on_time, history], ignore_index=True)
+    dates = reading_times(candidates['Date'])
+    latest = candidates.loc[dates.sort_values(kind='stable').index]
+    latest = latest.groupby('Printer ID', dropna=False, sort=False).tail(1)
+
+    store.append_daily_usage(daily_usage, latest, int(readings['Reading ID'].max()))
+    if len(late):
+        print(f"Recomputed the daily usage of {len(late)} printers with late readings.")
+    print(f"Added {len(readings)} rows to the Printer Daily Usage table.")
+    return len(readings)
+
+# One row per printer and day for the daily sheets: the usage of the day's
+# readings summed, the other columns from the last reading of the day. A day
+# with one reading keeps its row as it is.
+def usage_per_day(usage_df):
+    if usage_df.empty:
+        return usage_df
+    times = reading_times(usage_df['Date'])
+    days = usage_df.assign(Date=times.dt.strftime('%Y-%m-%d').fillna(usage_df['Date']))
+    for col in COUNTER_COLUMNS:
+        days[col] = pd.to_numeric(days[col], errors='coerce')
+    printer_days = days.groupby(['Printer ID', 'Date'], dropna=False, sort=False)
+    others = [col for col in usage_df.columns if col not in COUNTER_COLUMNS + ['Printer ID', 'Date']]
+    per_day = pd.concat([printer_days[others].last(), printer_days[COUNTER_COLUMNS].sum(min_count=1)], axis=1)
+    for col in COUNTER_COLUMNS:
+        per_day[col] = per_day[col].astype('Int64')
+    return per_day.reset_index()[list(usage_df.columns)]
+
+# Page ID of each counter column, as in the pages table
+PAGE_IDS = {'A4 page': 1, 'A5 page': 2}
+
+# Long format of the daily usage: one row per reading and page size with the
+# id_columns, 'Page ID' and 'Page Count'. Readings missing a counter are left
+# out, the rows keep the reading order with A4 before A5.
+def unpivot_usage(daily_usage_df, id_columns=('Printer ID',)):
+    complete = daily_usage_df[daily_usage_df[COUNTER_COLUMNS].notna().all(axis=1)]
+    usage = complete.melt(id_vars=list(id_columns), value_vars=COUNTER_COLUMNS, var_name='Page ID',
+                          value_name='Page Count', ignore_index=False)
+    usage['Page ID'] = usage['Page ID'].map(PAGE_IDS)
+    return usage.sort_index(kind='stable').reset_index(drop=True)
+
+def create_printer_usage_table(daily_usage_df):
+    usage = unpivot_usage(daily_usage_df)
+    print("Printer usage table created for the Printer Usage sheet.")
+    return usage[["Printer ID", "Page ID", "Page Count"]]
+
+if __name__ == '__main__':
+    # Workbook and sheet can be passed on the command line
+    parser = argparse.ArgumentParser(description='Compute the printer daily usage')
+    parser.add_argument('excel_file', nargs='?', default=EXCEL_FILE)
+    parser.add_argument('sheet_name', nargs='?', default='printers')
+    parser.add_argument('--rebuild', action='store_true', help='recompute the daily usage from the whole history')
+    args = parser.parse_args()
+
+    # Imported here, the pipeline imports this module
+    import printer_pipeline
+    try:
+        with open_store(excel_file=args.excel_file, sheet_name=args.sheet_name) as store:
+            update_daily_usage(store, rebuild=args.rebuild)
+            daily_usage_df = usage_per_day(store.daily_usage())
+            usage_df = create_printer_usage_table(daily_usage_df)
+            printer_pipeline.export_store(store, args.excel_file,
+                                          {"Printer Daily Usage": daily_usage_df, "Printer Usage": usage_df},
+                                          args.sheet_name)
+    except Exception as e:
+        print(f"Error occurred: {e}")
@@ -0,0 +1,93 @@
+import logging
+import sqlite3
+
+from metrics_store import DB_FILE
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS printer_registry (
+    identity TEXT PRIMARY KEY,
+    printer_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS printer_registry_id ON printer_registry (printer_id);
+"""
+
+
+# Stable identity of a printer reading: the scraped IP address, falling back
+# to the printer name when the page didn't give one
+def printer_identity(row):
+    for column in ('IP Address', 'Printer name'):
+        value = row.get(column)
+        if value is not None and str(value).strip():
+            return str(value).strip().lower()
+    return None
+
+
+# Normalized form of a column of IP addresses, the same one printer_identity
+# gives a single address
+def ip_keys(addresses):
+    return addresses.astype('string').str.strip().str.lower()
+
+
+class PrinterRegistry:
+    # Persistent printer identity -> printer ID map shared by every scraper.
+    # Lookups hit an in-memory dict; new IDs are assigned inside a write
+    # transaction so concurrent scrapers can't hand out the same ID twice.
+    def __init__(self, path=DB_FILE):
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.executescript(SCHEMA)
+        self._seed_from_readings()
+        self.ids = dict(self.conn.execute('SELECT identity, printer_id FROM printer_registry'))
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Carry over the IDs already used in the readings history the first time
+    def _seed_from_readings(self):
+        if self.conn.execute('SELECT 1 FROM printer_registry LIMIT 1').fetchone():
+            return
+        if not self.conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'readings'").fetchone():
+            return
+        rows = self.conn.execute(
+            'SELECT ip_address, printer_id, MAX(reading_id) FROM readings '
+            'WHERE printer_id IS NOT NULL AND ip_address IS NOT NULL GROUP BY ip_address')
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO printer_registry VALUES (?, ?)',
+                [(ip_address.strip().lower(), printer_id) for ip_address, printer_id, _ in rows])
+
+    # Get the printer ID for an identity, assigning the next free ID if it's new
+    def get_printer_id(self, identity):
+        if identity in self.ids:
+            return self.ids[identity]
+        # BEGIN IMMEDIATE takes the write lock before reading, so another
+        # scraper can't pick the same max ID in between
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.conn.execute(
+                'SELECT printer_id FROM printer_registry WHERE identity = ?', (identity,)).fetchone()
+            if row:
+                printer_id = row[0]
+            else:
+                printer_id = self.conn.execute(
+                    'SELECT COALESCE(MAX(printer_id), 0) + 1 FROM printer_registry').fetchone()[0]
+                self.conn.execute('INSERT INTO printer_registry VALUES (?, ?)', (identity, printer_id))
+                logging.info(f"Assigned printer ID {printer_id} to {identity}.")
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.ids[identity] = printer_id
+        return printer_id
+
+    # Fill in 'Printer ID' on a run's rows
+    def assign(self, rows):
+        for row in rows:
+            row['Printer ID'] = self.get_printer_id(printer_identity(row))
+        return rows
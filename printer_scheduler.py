@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from datetime import datetime
+
+import requests
+
+from metrics_store import DB_FILE
+from snmp import SnmpError
+
+# Consecutive unreachable runs before a printer's circuit opens. An open
+# printer only gets a cheap probe until it answers again.
+FAILURE_THRESHOLD = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS printer_health (
+    address TEXT PRIMARY KEY,
+    failures INTEGER NOT NULL DEFAULT 0,
+    last_success TEXT,
+    last_failure TEXT,
+    last_error TEXT,
+    seconds REAL
+);
+"""
+
+
+# Errors that say the printer is unreachable or busy rather than broken: the
+# connection failed or timed out, or the EWS answered with a 5xx
+def is_transient(error):
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code >= 500
+    return isinstance(error, (requests.ConnectionError, requests.Timeout, SnmpError, asyncio.TimeoutError))
+
+
+class PrinterHealth:
+    # Health of one printer address, carried over from run to run
+    def __init__(self, address, failures=0, last_success=None, last_failure=None, last_error=None, seconds=None):
+        self.address = address
+        self.failures = failures
+        self.last_success = last_success
+        self.last_failure = last_failure
+        self.last_error = last_error
+        self.seconds = seconds
+
+    def succeeded(self, seconds):
+        self.failures = 0
+        self.last_success = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.seconds = seconds
+
+    def failed(self, error):
+        self.failures += 1
+        self.last_failure = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.last_error = str(error)
+
+    def row(self):
+        return (self.address, self.failures, self.last_success, self.last_failure, self.last_error, self.seconds)
+
+
+class PrinterScheduler:
+    # Decides which printers a run polls and in what order. Healthy printers go
+    # first (fastest first), printers with an open circuit get one probe
+    # instead of a full scrape, and printers that failed with a transient
+    # error are polled once more after everything else. Health is saved in
+    # the metrics database at the end of the run.
+    def __init__(self, path=DB_FILE, window=0, threshold=FAILURE_THRESHOLD):
+        self.path = path
+        self.window = window
+        self.threshold = threshold
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.executescript(SCHEMA)
+        self.health = {
+            row[0]: PrinterHealth(*row) for row in self.conn.execute(
+                'SELECT address, failures, last_success, last_failure, last_error, seconds FROM printer_health')
+        }
+        self.skipped = []
+        self._requeue = {}
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _health(self, address):
+        if address not in self.health:
+            self.health[address] = PrinterHealth(address)
+        return self.health[address]
+
+    def is_open(self, address):
+        return self._health(address).failures >= self.threshold
+
+    # Healthy printers first, fastest first; struggling ones after them and
+    # open circuits last
+    def order(self, ip_addresses):
+        def key(address):
+            health = self._health(address)
+            return (self.is_open(address), health.failures,
+                    health.seconds if health.seconds is not None else float('inf'))
+        return sorted(dict.fromkeys(ip_addresses), key=key)
+
+    # Wrap a collector so every poll is scheduled and its outcome recorded.
+    # offsets spreads the printers' start times over the window. Without
+    # requeue a transient failure counts against the printer at once.
+    def _scheduled(self, name, collector, offsets, second_pass, requeue=True):
+        async def poll(poller, ip_address):
+            health = self._health(ip_address)
+            if offsets.get(ip_address):
+                await asyncio.sleep(offsets[ip_address])
+            if self.is_open(ip_address) and not second_pass:
+                if await poller.probe(ip_address) is None:
+                    health.failed('probe failed')
+                    self.skipped.append(ip_address)
+                    return None
+                logging.info(f"{ip_address} answered its probe, polling it again.")
+
+            start = time.perf_counter()
+            try:
+                row = await collector(poller, ip_address)
+            except Exception as e:
+                if not is_transient(e):
+                    # The printer answered, the page is the problem
+                    health.succeeded(time.perf_counter() - start)
+                    raise
+                if second_pass or not requeue:
+                    health.failed(e)
+                    raise
+                logging.warning(f"Transient error for printer at IP address {ip_address}, "
+                                f"retrying at the end of the run: {str(e)}")
+                self._requeue.setdefault(name, []).append(ip_address)
+                return None
+            health.succeeded(time.perf_counter() - start)
+            return row
+        return poll
+
+    # Wrap a collector for continuous polling (the daemon): one poll at a time,
+    # open circuits get a probe and failures are recorded straight away
+    def tracked(self, collector):
+        return self._scheduled(None, collector, {}, False, requeue=False)
+
+    def _offsets(self, ip_addresses):
+        if not self.window or len(ip_addresses) < 2:
+            return {}
+        step = self.window / len(ip_addresses)
+        return {address: i * step for i, address in enumerate(ip_addresses)}
+
+    # Run fleets ({name: (ip_addresses, collector)}) on the poller: one pass
+    # over every printer, then a second pass over the transient failures.
+    # Returns {name: rows} like FleetPoller.run_many.
+    def run(self, poller, fleets):
+        ordered = {name: self.order(ip_addresses) for name, (ip_addresses, _) in fleets.items()}
+        self.skipped = []
+        self._requeue = {}
+        first = {
+            name: (ordered[name], self._scheduled(name, collector, self._offsets(ordered[name]), False))
+            for name, (_, collector) in fleets.items()
+        }
+        results = poller.run_many(first)
+
+        if self._requeue:
+            logging.info(f"Second pass over {sum(len(a) for a in self._requeue.values())} printers.")
+            second = {
+                name: (ip_addresses, self._scheduled(name, fleets[name][1], {}, True))
+                for name, ip_addresses in self._requeue.items()
+            }
+            for name, rows in poller.run_many(second).items():
+                results[name] = results[name] + rows
+
+        if self.skipped:
+            logging.info(f"Skipped {len(self.skipped)} printers with an open circuit: {', '.join(self.skipped)}")
+        self.save()
+        return results
+
+    # Write every printer's health in one transaction
+    def save(self):
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO printer_health VALUES (?, ?, ?, ?, ?, ?)',
+                                  [health.row() for health in self.health.values()])
@@ -0,0 +1,284 @@
+import hashlib
+import random
+import socket
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from snmp import (HR_DEVICE_DESCR, PRT_MARKER_LIFE_COUNT, SYS_NAME, _GET_REQUEST, _GET_RESPONSE,
+                  decode_message, encode_message, encode_value)
+
+# Linux value, the socket module only names it from Python 3.12
+IP_PKTINFO = getattr(socket, 'IP_PKTINFO', 8)
+
+# Canned FutureSmart EWS pages, reduced to the elements the scrapers read
+FUTURESMART_PAGES = {
+    '/':
+        '<html><head><meta http-equiv="refresh" content="0; url=/hp/device/DeviceStatus/Index"></head></html>',
+    '/hp/device/DeviceInformation/View':
+        '<html><body><p id="DeviceName">{model}</p></body></html>',
+    '/hp/device/InternalPages/Index?id=UsagePage':
+        '<html><body><table>'
+        '<tr><td id="UsagePage.ImpressionsByMediaSizeTable.Print.A4.Total">{a4:,}</td></tr>'
+        '<tr><td id="UsagePage.ImpressionsByMediaSizeTable.Print.A5.Total">{a5:,}</td></tr>'
+        '</table></body></html>',
+    '/hp/device/DeviceStatus/Index':
+        '<html><body><p id="HomeDeviceIp">{ip}</p></body></html>',
+    '/network_id.htm':
+        '<html><body><input id="IPv4_HostName" value="{name}"/></body></html>',
+}
+
+# Canned M501dn EWS pages (French firmware), reduced the same way
+_M501DN_NETWORK = (
+    '<html><body><table>'
+    '<tr><td class="itemFont">{name}</td></tr><tr><td class="itemFont">{ip}</td></tr>'
+    '</table><h3 class="subTitle">Identification réseau</h3>'
+    '<table><tr><td class="itemFont">{name}</td></tr></table></body></html>'
+)
+M501DN_PAGES = {
+    '/':
+        '<html><head><meta http-equiv="refresh" '
+        'content="0; url=/info_deviceStatus.html?tab=Home&menu=DevStatus"></head></html>',
+    '/info_configuration.html?tab=Home&menu=DevConfig':
+        '<html><body><table><tr><td class="itemFont">{model}</td></tr></table>'
+        '<h3 class="subTitle">Impressions</h3>'
+        '<table><tr><td class="itemFont">{a5:,}</td></tr></table></body></html>',
+    '/info_config_network.html?tab=Home&menu=NetConfig': _M501DN_NETWORK,
+    '/info_config_network.html?tab=Networking&menu=NetConfig': _M501DN_NETWORK,
+}
+
+PAGES = {
+    'futuresmart': FUTURESMART_PAGES,
+    'm501dn': M501DN_PAGES,
+}
+
+
+class SimulatedPrinter:
+    # One fake printer: the values its pages report and how it answers. Every
+    # answer takes delay plus up to jitter seconds, error_rate of them are 500
+    # errors, and filler_rows pads the pages with the navigation and status
+    # markup real EWS pages carry around the values. seed makes the jitter and
+    # errors repeatable (it defaults to the address).
+    def __init__(self, ip, family='futuresmart', model=None, name=None, a4=0, a5=0, delay=0.0, jitter=0.0,
+                 error_rate=0.0, filler_rows=0, seed=None):
+        self.ip = ip
+        self.family = family
+        self.model = model or ('HP LaserJet Pro M501dn' if family == 'm501dn' else 'HP LaserJet MFP E52645')
+        self.name = name or f'PRN-{ip.replace(".", "-").replace(":", "-")}'
+        self.a4 = a4
+        self.a5 = a5
+        self.delay = delay
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.filler = ''.join(f'<tr><td class="labelFont" id="row{i}">Setting {i}</td><td>Value {i}</td></tr>'
+                              for i in range(filler_rows // 2))
+        self._random = random.Random(ip if seed is None else seed)
+        self._served = {}
+
+    def render(self, path):
+        template = PAGES[self.family].get(path)
+        if template is None:
+            return None
+        page = template.format(model=self.model, name=self.name, ip=self.ip, a4=self.a4, a5=self.a5)
+        if self.filler:
+            page = page.replace('<body>', f'<body><table>{self.filler}</table>', 1)
+            page = page.replace('</body>', f'<table>{self.filler}</table></body>', 1)
+        return page
+
+    # Encoded page and its ETag (FutureSmart only), or None for an unknown
+    # path. Kept until the values change, so the simulator's own CPU time
+    # doesn't show up in the fleet benchmark's latencies.
+    def serve(self, path):
+        key = (path, self.model, self.name, self.a4, self.a5)
+        if key not in self._served:
+            page = self.render(path)
+            if page is None:
+                return None
+            body = page.encode('utf-8')
+            # FutureSmart firmware tags its pages with an ETag and answers a
+            # matching If-None-Match with 304, the M501dn sends no validators
+            etag = f'"{hashlib.md5(body).hexdigest()}"' if self.family == 'futuresmart' else None
+            if len(self._served) > 64:
+                # Counters changed many times, drop the old values' pages
+                self._served.clear()
+            self._served[key] = (body, etag)
+        return self._served[key]
+
+    # Seconds the next answer takes
+    def latency(self):
+        return self.delay + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+
+    # Whether the next answer is a server error
+    def fails(self):
+        return self.error_rate > 0 and self._random.random() < self.error_rate
+
+
+class _EwsHandler(BaseHTTPRequestHandler):
+    # Keep connections alive like the printers' embedded servers do
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        printer = self.server.printers.get(self.headers.get('Host'))
+        served = printer.serve(self.path) if printer else None
+        if printer:
+            latency = printer.latency()
+            if latency:
+                time.sleep(latency)
+            if printer.fails():
+                self.send_error(500)
+                return
+        if served is None:
+            self.send_error(404)
+            return
+        body, etag = served
+        if etag and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _FleetServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # A whole fleet connects at once
+
+
+class PrinterSimulator:
+    # Serves canned EWS pages for many fake printers from one local port. Every
+    # printer gets its own loopback IP (127.x.y.z:<port>) and is told apart by
+    # the Host header, so the scrapers can use the address as the ip_address
+    # they put in their URLs. Binding to all interfaces is what makes the whole
+    # 127.0.0.0/8 range reachable.
+    def __init__(self, host='0.0.0.0', port=0):
+        self.server = _FleetServer((host, port), _EwsHandler)
+        self.server.printers = {}
+        self._thread = None
+        self._closed_port = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    # Register a printer and return the address the scrapers should poll
+    def add_printer(self, index, **kwargs):
+        n = index + 2
+        address = f'127.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}:{self.port}'
+        self.server.printers[address] = SimulatedPrinter(address, **kwargs)
+        return address
+
+    # Address of an offline printer: a port nothing listens on, so every
+    # connection to it is refused
+    def add_offline(self, index):
+        if self._closed_port is None:
+            with socket.socket() as sock:
+                sock.bind(('127.0.0.1', 0))
+                self._closed_port = sock.getsockname()[1]
+        n = index + 2
+        return f'127.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}:{self._closed_port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class SnmpAgentSimulator:
+    # SNMP agent for the printers of a PrinterSimulator on one UDP port. The
+    # printer is picked from the loopback address the GET was sent to, read
+    # with IP_PKTINFO (Linux). media_oids maps 'a4'/'a5' to the OIDs that
+    # should report the per-media-size counters.
+    def __init__(self, fleet, host='0.0.0.0', port=0, media_oids=None):
+        self.fleet = fleet
+        self.media_oids = media_oids or {}
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.IPPROTO_IP, IP_PKTINFO, 1)
+        self.sock.bind((host, port))
+        self._thread = None
+        self._running = False
+
+    @property
+    def port(self):
+        return self.sock.getsockname()[1]
+
+    def _printer(self, ip):
+        for address, printer in list(self.fleet.server.printers.items()):
+            if address.split(':')[0] == ip:
+                return printer
+        return None
+
+    def _values(self, printer):
+        values = {
+            SYS_NAME: printer.name,
+            HR_DEVICE_DESCR: printer.model,
+            PRT_MARKER_LIFE_COUNT: printer.a4 + printer.a5,
+        }
+        for size, oid in self.media_oids.items():
+            values[oid] = getattr(printer, size)
+        return values
+
+    def _answer(self, data, sender, local_ip):
+        printer = self._printer(local_ip)
+        if printer is None:
+            return
+        pdu_type, request_id, community, _, varbinds = decode_message(data)
+        if pdu_type != _GET_REQUEST:
+            return
+        values = self._values(printer)
+        # Unknown OIDs are answered with noSuchObject
+        answer = encode_message(_GET_RESPONSE, request_id, community,
+                                [(oid, encode_value(values[oid]) if oid in values else b'\x80\x00')
+                                 for oid, _ in varbinds])
+        if printer.delay:
+            time.sleep(printer.delay)
+        pktinfo = struct.pack('I4s4s', 0, socket.inet_aton(local_ip), b'\0' * 4)
+        self.sock.sendmsg([answer], [(socket.IPPROTO_IP, IP_PKTINFO, pktinfo)], 0, sender)
+
+    def _serve(self):
+        while self._running:
+            try:
+                data, ancdata, _, sender = self.sock.recvmsg(65535, socket.CMSG_SPACE(12))
+            except OSError:
+                break
+            local_ip = None
+            for level, kind, value in ancdata:
+                if level == socket.IPPROTO_IP and kind == IP_PKTINFO:
+                    local_ip = socket.inet_ntoa(value[8:12])
+            # Answer from a thread so slow printers don't hold up the others
+            threading.Thread(target=self._answer, args=(data, sender, local_ip), daemon=True).start()
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self.sock.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
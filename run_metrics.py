@@ -0,0 +1,105 @@
+import json
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+# JSON lines file the timings of every run are appended to
+METRICS_FILE = 'printer_metrics.jsonl'
+
+
+# Nearest-rank percentile of a list of numbers
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(math.ceil(p * len(ordered) / 100) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+class RunMetrics:
+    # Timings of one run: page fetches, parsing, storage writes and pipeline
+    # stages. Events are kept in memory and appended to the JSON lines file
+    # when the run is written; path=None keeps them in memory only.
+    def __init__(self, path=METRICS_FILE):
+        self.path = path
+        self.run_id = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        self.events = []
+        self._lock = threading.Lock()
+
+    def record(self, kind, seconds, **fields):
+        event = {'run': self.run_id, 'kind': kind, 'seconds': round(seconds, 6), **fields}
+        with self._lock:
+            self.events.append(event)
+        return event
+
+    # Time the body of a with block as one event, failures are recorded too
+    @contextmanager
+    def timer(self, kind, **fields):
+        start = time.perf_counter()
+        try:
+            yield fields
+        except Exception as e:
+            fields['error'] = str(e)
+            raise
+        finally:
+            self.record(kind, time.perf_counter() - start, **fields)
+
+    # Start a new run on the same object, for callers that write one every
+    # so often instead of once at the end (the daemon)
+    def reset(self):
+        with self._lock:
+            self.run_id = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+            self.events = []
+
+    def of_kind(self, kind):
+        return [event for event in self.events if event['kind'] == kind]
+
+    # Latency percentiles, stage wall-clock and the slowest printers
+    def summary(self, slowest=10):
+        fetches = self.of_kind('fetch')
+        latencies = [event['seconds'] for event in fetches]
+        per_printer = {}
+        for event in fetches + self.of_kind('parse'):
+            printer = event.get('printer')
+            per_printer[printer] = per_printer.get(printer, 0) + event['seconds']
+        return {
+            'run': self.run_id,
+            'fetches': len(fetches),
+            'fetch_errors': sum(1 for event in fetches if 'error' in event),
+            'fetch_p50': percentile(latencies, 50),
+            'fetch_p95': percentile(latencies, 95),
+            'fetch_max': max(latencies) if latencies else None,
+            'parse_total': round(sum(event['seconds'] for event in self.of_kind('parse')), 3),
+            'storage_total': round(sum(event['seconds'] for event in self.of_kind('storage')), 3),
+            'stages': {event['stage']: round(event['seconds'], 3) for event in self.of_kind('stage')},
+            'slowest_printers': [(printer, round(seconds, 3)) for printer, seconds in
+                                 sorted(per_printer.items(), key=lambda item: item[1], reverse=True)[:slowest]],
+        }
+
+    # Append the events and the summary to the metrics file and log the summary
+    def write(self):
+        summary = self.summary()
+        if self.path:
+            with open(self.path, 'a') as file:
+                for event in self.events:
+                    file.write(json.dumps(event) + '\n')
+                file.write(json.dumps({'kind': 'summary', **summary}) + '\n')
+        log_summary(summary)
+        return summary
+
+
+def _seconds(value):
+    return '-' if value is None else f'{value:.3f}s'
+
+def log_summary(summary):
+    logging.info(f"Run summary: {summary['fetches']} fetches ({summary['fetch_errors']} failed), "
+                 f"latency p50 {_seconds(summary['fetch_p50'])}, p95 {_seconds(summary['fetch_p95'])}, "
+                 f"max {_seconds(summary['fetch_max'])}; parse {summary['parse_total']}s, "
+                 f"storage {summary['storage_total']}s")
+    for stage, seconds in summary['stages'].items():
+        logging.info(f"Stage {stage}: {seconds}s")
+    for printer, seconds in summary['slowest_printers']:
+        logging.info(f"Slow printer {printer}: {seconds:.3f}s")
@@ -0,0 +1,103 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import zlib
+from datetime import datetime
+
+from metrics_store import COLUMNS
+from printer_discovery import expand
+from printer_registry import PrinterRegistry
+
+# Directory the collectors write their partial result files to
+PARTIALS_DIR = 'partials'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS merged_partials (
+    name TEXT PRIMARY KEY,
+    rows INTEGER NOT NULL,
+    merged_at TEXT NOT NULL
+);
+"""
+
+
+class Shard:
+    # Slice of the fleet one collector polls: 'i/n' (1-based) takes the
+    # addresses whose CRC32 falls in bucket i of n, so an address stays on the
+    # same collector when the lists change; any other spec is a site tag and
+    # takes the addresses tagged with that site in the printer lists.
+    def __init__(self, spec):
+        index, _, count = spec.partition('/')
+        self.site = None
+        if count:
+            self.index, self.count = int(index), int(count)
+            if not 1 <= self.index <= self.count:
+                raise ValueError(f"Shard {spec} is out of range, use i/n with 1 <= i <= n")
+        else:
+            self.site = spec
+        self.label = spec.replace('/', 'of')
+
+    def selects(self, address, site=None):
+        if self.site is not None:
+            return site == self.site
+        return zlib.crc32(address.encode()) % self.count == self.index - 1
+
+    def select(self, addresses, sites=None):
+        sites = sites or {}
+        return [address for address in addresses if self.selects(address, sites.get(address))]
+
+
+# Site tag of every address of a printer list or inventory: the optional
+# second column of a line ("10.1.2.0/24 lyon")
+def read_sites(path):
+    sites = {}
+    with open(path, 'r') as file:
+        for line in file:
+            fields = line.split('#')[0].split()
+            if len(fields) > 1:
+                for address in expand(fields[0]):
+                    sites[address] = fields[1]
+    return sites
+
+
+# Write one collector's rows (without printer IDs) to its own partial result
+# file and return its path. The file is renamed into place once complete, so
+# the merge never reads half a file.
+def write_partial(rows, shard, directory=PARTIALS_DIR):
+    os.makedirs(directory, exist_ok=True)
+    name = f"{socket.gethostname()}-{shard.label}-{datetime.now().strftime('%Y%m%dT%H%M%S%f')}.jsonl"
+    path = os.path.join(directory, name)
+    with open(path + '.tmp', 'w') as file:
+        for row in rows:
+            file.write(json.dumps({column: row.get(column) for column in COLUMNS if column != 'Printer ID'},
+                                  default=str) + '\n')
+    os.replace(path + '.tmp', path)
+    logging.info(f"Wrote {len(rows)} readings to {path}.")
+    return path
+
+
+# Merge the partial files not merged yet into the store. Printer IDs come from
+# the store's registry, so a printer gets the same ID whichever shard polled
+# it, and readings already in the store (same printer, day and counters) are
+# skipped, so merging a file twice or overlapping shards add nothing.
+def merge_partials(store, directory=PARTIALS_DIR):
+    conn = sqlite3.connect(store.path, timeout=30)
+    try:
+        conn.executescript(SCHEMA)
+        merged = {name for name, in conn.execute('SELECT name FROM merged_partials')}
+        names = sorted(name for name in os.listdir(directory) if name.endswith('.jsonl') and name not in merged)
+        added = 0
+        with PrinterRegistry(store.path) as registry:
+            for name in names:
+                with open(os.path.join(directory, name)) as file:
+                    rows = [json.loads(line) for line in file if line.strip()]
+                registry.assign(rows)
+                added += store.insert_readings(rows, skip_existing=True)
+                with conn:
+                    conn.execute('INSERT INTO merged_partials VALUES (?, ?, ?)',
+                                 (name, len(rows), datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        logging.info(f"Merged {len(names)} partial files from {directory}, {added} new readings.")
+        return added
+    finally:
+        conn.close()
@@ -0,0 +1,178 @@
+import asyncio
+import itertools
+import logging
+
+# Standard MIB objects every printer answers
+SYS_NAME = '1.3.6.1.2.1.1.5.0'                          # SNMPv2-MIB sysName
+HR_DEVICE_DESCR = '1.3.6.1.2.1.25.3.2.1.3.1'            # HOST-RESOURCES-MIB hrDeviceDescr
+PRT_MARKER_LIFE_COUNT = '1.3.6.1.2.1.43.10.2.1.4.1.1'   # Printer-MIB prtMarkerLifeCount
+
+SNMP_PORT = 161
+COMMUNITY = 'public'
+TIMEOUT = 2      # Seconds to wait for an answer
+RETRIES = 1      # Resends after a timeout
+
+# BER tags
+_INTEGER = 0x02
+_OCTET_STRING = 0x04
+_NULL = 0x05
+_OID = 0x06
+_SEQUENCE = 0x30
+_GET_REQUEST = 0xA0
+_GET_RESPONSE = 0xA2
+# Application types that carry unsigned integers (IpAddress is decoded apart)
+_IP_ADDRESS = 0x40
+_UNSIGNED = {0x41, 0x42, 0x43, 0x46}   # Counter32, Gauge32, TimeTicks, Counter64
+# Exceptions in a response varbind
+_NO_VALUE = {0x80, 0x81, 0x82}         # noSuchObject, noSuchInstance, endOfMibView
+
+
+class SnmpError(Exception):
+    pass
+
+
+def _length(n):
+    if n < 0x80:
+        return bytes([n])
+    body = n.to_bytes((n.bit_length() + 7) // 8, 'big')
+    return bytes([0x80 | len(body)]) + body
+
+def _tlv(tag, body):
+    return bytes([tag]) + _length(len(body)) + body
+
+def _integer(value):
+    return _tlv(_INTEGER, value.to_bytes(value.bit_length() // 8 + 1, 'big', signed=True))
+
+def _oid(oid):
+    arcs = [int(arc) for arc in oid.split('.')]
+    body = bytearray([arcs[0] * 40 + arcs[1]])
+    for arc in arcs[2:]:
+        chunk = [arc & 0x7F]
+        arc >>= 7
+        while arc:
+            chunk.append(0x80 | (arc & 0x7F))
+            arc >>= 7
+        body.extend(reversed(chunk))
+    return _tlv(_OID, bytes(body))
+
+
+# SNMPv2c message: version, community and one PDU with a varbind per OID
+def encode_message(pdu_type, request_id, community, varbinds, error_status=0, error_index=0):
+    bindings = b''.join(_tlv(_SEQUENCE, _oid(oid) + value) for oid, value in varbinds)
+    pdu = _tlv(pdu_type, _integer(request_id) + _integer(error_status) + _integer(error_index)
+               + _tlv(_SEQUENCE, bindings))
+    return _tlv(_SEQUENCE, _integer(1) + _tlv(_OCTET_STRING, community.encode()) + pdu)
+
+def encode_get(request_id, community, oids):
+    return encode_message(_GET_REQUEST, request_id, community, [(oid, _tlv(_NULL, b'')) for oid in oids])
+
+def encode_value(value):
+    if isinstance(value, int):
+        # Page counters go out as Counter32
+        return _tlv(0x41, value.to_bytes(value.bit_length() // 8 + 1, 'big'))
+    return _tlv(_OCTET_STRING, str(value).encode('utf-8'))
+
+
+def _read(data, offset):
+    tag = data[offset]
+    length = data[offset + 1]
+    offset += 2
+    if length & 0x80:
+        size = length & 0x7F
+        length = int.from_bytes(data[offset:offset + size], 'big')
+        offset += size
+    return tag, data[offset:offset + length], offset + length
+
+def _items(data):
+    offset = 0
+    while offset < len(data):
+        tag, body, offset = _read(data, offset)
+        yield tag, body
+
+def _decode_oid(body):
+    arcs = [body[0] // 40, body[0] % 40]
+    arc = 0
+    for byte in body[1:]:
+        arc = (arc << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            arcs.append(arc)
+            arc = 0
+    return '.'.join(str(arc) for arc in arcs)
+
+def _decode_value(tag, body):
+    if tag == _INTEGER:
+        return int.from_bytes(body, 'big', signed=True)
+    if tag in _UNSIGNED:
+        return int.from_bytes(body, 'big')
+    if tag == _OCTET_STRING:
+        return body.decode('utf-8', errors='replace')
+    if tag == _IP_ADDRESS:
+        return '.'.join(str(byte) for byte in body)
+    if tag == _OID:
+        return _decode_oid(body)
+    if tag == _NULL or tag in _NO_VALUE:
+        return None
+    return body
+
+
+# Decode a message into (pdu type, request id, community, error status,
+# [(oid, value)])
+def decode_message(data):
+    _, message, _ = _read(data, 0)
+    (_, _), (_, community), (pdu_type, pdu) = list(_items(message))
+    (_, request_id), (_, error_status), (_, _), (_, bindings) = list(_items(pdu))
+    varbinds = []
+    for _, binding in _items(bindings):
+        (_, oid), (tag, value) = list(_items(binding))
+        varbinds.append((_decode_oid(oid), _decode_value(tag, value)))
+    return (pdu_type, int.from_bytes(request_id, 'big', signed=True), community.decode(),
+            int.from_bytes(error_status, 'big'), varbinds)
+
+
+class SnmpClient(asyncio.DatagramProtocol):
+    # One UDP socket shared by every GET in flight; answers are matched to
+    # their request by request id, so a whole fleet can be polled at once.
+    def __init__(self):
+        self.transport = None
+        self._pending = {}
+        self._ids = itertools.count(1)
+
+    @classmethod
+    async def open(cls):
+        loop = asyncio.get_running_loop()
+        _, client = await loop.create_datagram_endpoint(cls, local_addr=('0.0.0.0', 0))
+        return client
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            pdu_type, request_id, _, error_status, varbinds = decode_message(data)
+        except (IndexError, ValueError) as e:
+            logging.warning(f"Malformed SNMP answer from {addr[0]}: {e}")
+            return
+        future = self._pending.pop(request_id, None)
+        if future and not future.done() and pdu_type == _GET_RESPONSE:
+            if error_status:
+                future.set_exception(SnmpError(f"SNMP error status {error_status} from {addr[0]}"))
+            else:
+                future.set_result(dict(varbinds))
+
+    # GET every OID from one printer in a single request, resent on timeout
+    async def get(self, host, oids, port=SNMP_PORT, community=COMMUNITY, timeout=TIMEOUT, retries=RETRIES):
+        loop = asyncio.get_running_loop()
+        for attempt in range(retries + 1):
+            request_id = next(self._ids) & 0x7FFFFFFF
+            future = loop.create_future()
+            self._pending[request_id] = future
+            self.transport.sendto(encode_get(request_id, community, oids), (host, port))
+            try:
+                return await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                self._pending.pop(request_id, None)
+        raise SnmpError(f"No SNMP answer from {host} after {retries + 1} tries")
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+
+from metrics_store import COLUMNS
+
+# Synthetic printer histories and the reference delta loop, shared by the
+# benchmarks and the tests. Nothing here imports the scrapers, which set up
+# logging to printer_metrics.log when imported.
+
+# Synthetic printers sheet: `printers` devices read once a day
+def make_history(rows, printers=600):
+    index = np.arange(rows)
+    printer = index % printers
+    days = pd.date_range('2020-01-01', periods=rows // printers + 1).strftime('%Y-%m-%d')
+    data = {
+        'Printer ID': printer + 1,
+        'Date': np.asarray(days)[index // printers],
+        'Printer model': 'HP LaserJet MFP E52645',
+        'Printer name': pd.Series(printer + 1).map('PRN{:04d}'.format),
+        'IP Address': pd.Series(printer).map(lambda p: f'10.0.{p // 250}.{p % 250 + 1}'),
+        'A4 page': 1000 + index,
+        'A5 page': index // printers,
+    }
+    return pd.DataFrame(data, columns=COLUMNS)
+
+# Shuffled history with counter resets and unreadable values, the cases the
+# delta engine has to get right
+def make_messy_history(rows, printers=600, seed=0):
+    rng = np.random.default_rng(seed)
+    df = make_history(rows, printers)
+    df['A4 page'] = rng.integers(0, 50, rows).cumsum()
+    resets = rng.random(rows) < 0.01
+    df.loc[resets, 'A4 page'] = rng.integers(0, 10, resets.sum())
+    df['A5 page'] = df['A5 page'].astype(object)
+    df.loc[rng.random(rows) < 0.01, 'A5 page'] = None
+    return df.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+# Reference delta implementation: the original per-row loop from
+# printer_processing.py, run over the readings in date order
+def reference_daily_usage(printers_df):
+    order = pd.to_datetime(printers_df['Date'], format='ISO8601').sort_values(kind='stable').index
+    daily_usage = printers_df.copy()
+    prev_rows = {}
+    for index in order:
+        row = printers_df.loc[index]
+        printer_id = row['Printer ID']
+        if printer_id in prev_rows:
+            for col in ['A4 page', 'A5 page']:
+                try:
+                    current_value = int(row[col])
+                    prev_row_value = int(prev_rows[printer_id][col])
+                except (TypeError, ValueError):
+                    continue
+                if current_value < prev_row_value:
+                    daily_usage.at[index, col] = current_value
+                else:
+                    daily_usage.at[index, col] = current_value - prev_row_value
+        prev_rows[printer_id] = row
+    return daily_usage
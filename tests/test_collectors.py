@@ -0,0 +1,74 @@
+import pytest
+
+from collectors import SnmpCollector
+from printer_poller import FleetPoller
+from printer_simulator import PrinterSimulator, SnmpAgentSimulator
+from snmp import HR_DEVICE_DESCR, PRT_MARKER_LIFE_COUNT, SYS_NAME
+
+A4_OID = '1.3.6.1.4.1.11.2.3.9.4.2.1.4.1.2.7.0'
+
+FIELDS = {'Printer name': SYS_NAME, 'Printer model': HR_DEVICE_DESCR, 'A4 page': PRT_MARKER_LIFE_COUNT}
+
+
+@pytest.fixture
+def fleet():
+    with PrinterSimulator() as fleet, SnmpAgentSimulator(fleet, media_oids={'a4': A4_OID}) as agent:
+        fleet.agent = agent
+        yield fleet
+
+
+# EWS stand-in that records the printers it was asked for
+def fake_scraper(calls):
+    async def poll_printer(poller, ip_address):
+        calls.append(ip_address)
+        return {'IP Address': ip_address, 'Printer name': 'scraped'}
+    return poll_printer
+
+
+def test_snmp_get_round_trip(fleet):
+    address = fleet.add_printer(0, family='m501dn', a4=1234, a5=56)
+    printer = fleet.server.printers[address]
+    collector = SnmpCollector(FIELDS, {'A5 page': None}, port=fleet.agent.port)
+
+    rows = FleetPoller().run([address], collector)
+
+    assert len(rows) == 1
+    row = rows[0]
+    assert row['Printer name'] == printer.name
+    assert row['Printer model'] == printer.model
+    assert row['A4 page'] == 1234 + 56
+    assert row['A5 page'] is None
+    assert row['IP Address'] == address.split(':')[0]
+    assert 'Date' in row
+
+
+def test_missing_oid_falls_back_to_the_scraper(fleet):
+    address = fleet.add_printer(0, family='m501dn')
+    calls = []
+    fields = dict(FIELDS, **{'A5 page': '1.3.6.1.4.1.99999.1.0'})
+    collector = SnmpCollector(fields, fallback=fake_scraper(calls), port=fleet.agent.port)
+
+    rows = FleetPoller().run([address], collector)
+
+    assert calls == [address]
+    assert rows == [{'IP Address': address, 'Printer name': 'scraped'}]
+
+
+def test_unconfigured_oid_falls_back_or_fails_cleanly(fleet, caplog):
+    address = fleet.add_printer(0, family='m501dn')
+    fields = dict(FIELDS, **{'A5 page': None})
+    calls = []
+
+    rows = FleetPoller().run([address], SnmpCollector(fields, fallback=fake_scraper(calls), port=fleet.agent.port))
+    assert calls == [address]
+    assert len(rows) == 1
+
+    # Without a fallback the printer is logged as failed with the SNMP reason
+    assert FleetPoller().run([address], SnmpCollector(fields, port=fleet.agent.port)) == []
+    assert 'has no SNMP OID for every field' in caplog.text
+
+
+def test_configured_media_oid_is_read(fleet):
+    address = fleet.add_printer(0, family='m501dn', a4=321, a5=9)
+    collector = SnmpCollector({'A4 page': A4_OID}, port=fleet.agent.port)
+    assert FleetPoller().run([address], collector)[0]['A4 page'] == 321
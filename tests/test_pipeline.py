@@ -0,0 +1,38 @@
+import importlib
+
+import openpyxl
+import pytest
+
+from metrics_store import MetricsStore
+from printer_processing import update_daily_usage, usage_per_day
+from synthetic_history import make_history
+
+
+# The scrapers log to printer_metrics.log in the working directory as soon as
+# they're imported, so the pipeline is imported from inside tmp_path
+@pytest.fixture
+def printer_pipeline(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return importlib.import_module('printer_pipeline')
+
+
+def test_a_failed_run_exits_non_zero(printer_pipeline, monkeypatch):
+    def run_pipeline(*args, **kwargs):
+        raise RuntimeError('stage failed')
+    monkeypatch.setattr(printer_pipeline, 'run_pipeline', run_pipeline)
+    with pytest.raises(SystemExit) as exit_info:
+        printer_pipeline.main(['--stage', 'deltas'])
+    assert exit_info.value.code == 1
+
+
+def test_export_store_writes_every_sheet(printer_pipeline, tmp_path):
+    with MetricsStore(str(tmp_path / 'printer_metrics.db')) as store:
+        store.insert_readings(make_history(80, printers=20).to_dict('records'))
+        update_daily_usage(store)
+        usage = usage_per_day(store.daily_usage())
+        sheets = printer_pipeline.export_store(store, str(tmp_path / 'Printer_Metrics.xlsx'),
+                                               {'Printer Daily Usage': usage})
+    assert sheets['Printer Daily Usage'] is usage
+    workbook = openpyxl.load_workbook(tmp_path / 'Printer_Metrics.xlsx', read_only=True)
+    assert workbook.sheetnames == ['printers', 'pages', 'Printer Daily Usage', 'Printer Usage']
+    assert len(list(workbook['printers'].values)) == 81
@@ -0,0 +1,122 @@
+import pandas as pd
+import pytest
+
+from metrics_store import COLUMNS, MetricsStore
+from printer_processing import COUNTER_COLUMNS, calculate_difference, update_daily_usage, usage_per_day
+from synthetic_history import make_messy_history, reference_daily_usage
+
+
+def readings(*rows):
+    return pd.DataFrame([dict(zip(['Printer ID', 'Date', 'A4 page', 'A5 page'], row)) for row in rows])
+
+
+def assert_same_counters(actual, expected):
+    for col in COUNTER_COLUMNS:
+        same = (actual[col] == expected[col]) | (actual[col].isna() & expected[col].isna())
+        assert same.all(), f'{col} differs:\n{pd.concat([actual[col], expected[col]], axis=1)[~same]}'
+
+
+def test_first_reading_keeps_its_counters():
+    usage = calculate_difference(readings((1, '2024-01-01', 100, 10), (2, '2024-01-01', 50, 5)))
+    assert list(usage['A4 page']) == [100, 50]
+    assert list(usage['A5 page']) == [10, 5]
+
+
+def test_difference_with_the_previous_reading():
+    usage = calculate_difference(readings((1, '2024-01-01', 100, 10), (1, '2024-01-02', 130, 12)))
+    assert list(usage['A4 page']) == [100, 30]
+    assert list(usage['A5 page']) == [10, 2]
+
+
+def test_counter_reset_keeps_the_new_value():
+    usage = calculate_difference(readings((1, '2024-01-01', 100, 10), (1, '2024-01-02', 7, 10)))
+    assert list(usage['A4 page']) == [100, 7]
+    assert list(usage['A5 page']) == [10, 0]
+
+
+def test_missing_values_stay_as_they_are():
+    history = readings((1, '2024-01-01', 100, 10), (1, '2024-01-02', 120, None), (1, '2024-01-03', 150, 20))
+    usage = calculate_difference(history)
+    assert list(usage['A4 page']) == [100, 20, 30]
+    assert usage['A5 page'].isna().tolist() == [False, True, False]
+    assert usage['A5 page'].iloc[2] == 20
+    assert_same_counters(usage, reference_daily_usage(history))
+
+
+def test_out_of_order_dates_are_diffed_in_date_order():
+    history = readings((1, '2024-01-03', 150, 0), (1, '2024-01-01', 100, 0), (1, '2024-01-02', 120, 0))
+    usage = calculate_difference(history)
+    assert list(usage['A4 page']) == [30, 100, 20]
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_matches_the_reference_loop(seed):
+    history = make_messy_history(3000, printers=60, seed=seed)
+    assert_same_counters(calculate_difference(history), reference_daily_usage(history))
+
+
+def test_incremental_updates_match_a_rebuild(tmp_path):
+    history = make_messy_history(2000, printers=40, seed=3)
+    history = history.iloc[pd.to_datetime(history['Date']).argsort(kind='stable')].reset_index(drop=True)
+    store = MetricsStore(str(tmp_path / 'printer_metrics.db'))
+    try:
+        for chunk in range(4):
+            rows = history.iloc[chunk * 500:(chunk + 1) * 500].sample(frac=1, random_state=chunk)
+            store.insert_readings(rows[COLUMNS].to_dict('records'))
+            update_daily_usage(store)
+        incremental = store.daily_usage()
+
+        update_daily_usage(store, rebuild=True)
+        rebuilt = store.daily_usage()
+    finally:
+        store.close()
+    assert len(incremental) == len(history)
+    assert_same_counters(incremental, rebuilt)
+
+
+def test_late_readings_match_a_rebuild(tmp_path):
+    history = make_messy_history(2000, printers=40, seed=4)
+    store = MetricsStore(str(tmp_path / 'printer_metrics.db'))
+    try:
+        for chunk in range(4):
+            store.insert_readings(history.iloc[chunk * 500:(chunk + 1) * 500][COLUMNS].to_dict('records'))
+            update_daily_usage(store)
+        incremental = store.daily_usage()
+
+        update_daily_usage(store, rebuild=True)
+        rebuilt = store.daily_usage()
+    finally:
+        store.close()
+    assert len(incremental) == len(history)
+    assert_same_counters(incremental, rebuilt)
+
+
+def test_a_late_reading_is_diffed_against_the_reading_before_it(tmp_path):
+    store = MetricsStore(str(tmp_path / 'printer_metrics.db'))
+    try:
+        for row in [(1, '2024-01-05', 1000, 0), (1, '2024-01-04', 990, 0), (1, '2024-01-06', 1010, 0)]:
+            store.insert_readings(readings(row).to_dict('records'))
+            update_daily_usage(store)
+        usage = store.daily_usage()
+    finally:
+        store.close()
+    assert list(usage['Date']) == ['2024-01-05', '2024-01-04', '2024-01-06']
+    assert list(usage['A4 page']) == [10, 990, 10]
+
+
+def test_readings_of_the_same_day_are_diffed_in_time_order():
+    history = readings((1, '2024-01-01', 100, 0), (1, '2024-01-02 17:30:00', 160, 0),
+                       (1, '2024-01-02 08:15:00', 120, 0))
+    usage = calculate_difference(history)
+    assert list(usage['A4 page']) == [100, 40, 20]
+
+
+def test_usage_per_day_sums_the_readings_of_a_day():
+    usage = readings((1, '2024-01-01', 100, 10), (1, '2024-01-02 08:15:00', 20, 1),
+                     (2, '2024-01-02 09:00:00', 7, None), (1, '2024-01-02 17:30:00', 40, 2))
+    per_day = usage_per_day(usage)
+    assert list(per_day['Printer ID']) == [1, 1, 2]
+    assert list(per_day['Date']) == ['2024-01-01', '2024-01-02', '2024-01-02']
+    assert list(per_day['A4 page']) == [100, 60, 7]
+    assert per_day['A5 page'].isna().tolist() == [False, False, True]
+    assert per_day['A5 page'].iloc[1] == 3
@@ -0,0 +1,132 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+from metrics_store import MetricsStore
+from printer_simulator import PrinterSimulator
+from sharding import Shard, merge_partials, read_sites, write_partial
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SITES = ['lyon', 'porto']
+
+
+def reading(ip_address, date, a4, a5):
+    return {'Date': date, 'Printer model': 'HP LaserJet M501dn', 'Printer name': f'PRN-{ip_address}',
+            'IP Address': ip_address, 'A4 page': a4, 'A5 page': a5}
+
+
+# Simulated fleet of both model families with a printer list per family in
+# tmp_path, every address tagged with a site
+@pytest.fixture
+def fleet(tmp_path):
+    with PrinterSimulator() as fleet:
+        lists = {'IP Address.txt': [], 'M501dn.txt': []}
+        for i in range(12):
+            family = 'm501dn' if i % 3 == 0 else 'futuresmart'
+            address = fleet.add_printer(i, family=family, a4=1000 * i, a5=10 * i)
+            lists['M501dn.txt' if family == 'm501dn' else 'IP Address.txt'].append(f'{address} {SITES[i % 2]}')
+        for ip_file, lines in lists.items():
+            (tmp_path / ip_file).write_text('\n'.join(lines) + '\n')
+        yield fleet
+
+
+# Run sharded collectors as separate processes at the same time, the way
+# several machines would, each writing its partial file to tmp_path/partials
+def run_collectors(tmp_path, shards):
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    workers = [
+        subprocess.Popen([sys.executable, '-c', 'import printer_pipeline; printer_pipeline.main()',
+                          '--to', 'scrape-m501dn', '--full', '--shard', shard, '--partials', 'partials'],
+                         cwd=tmp_path, env=env, stdout=subprocess.DEVNULL)
+        for shard in shards
+    ]
+    assert [worker.wait(timeout=120) for worker in workers] == [0] * len(workers)
+
+
+def partial_rows(directory):
+    return sum(len(path.read_text().splitlines()) for path in directory.glob('*.jsonl'))
+
+
+def test_shards_split_the_fleet(fleet, tmp_path):
+    addresses = list(fleet.server.printers)
+    slices = [Shard(f'{i}/3').select(addresses) for i in range(1, 4)]
+    assert sorted(sum(slices, [])) == sorted(addresses)
+    assert Shard('2/3').select(addresses) == slices[1]
+
+    sites = read_sites(tmp_path / 'IP Address.txt')
+    sites.update(read_sites(tmp_path / 'M501dn.txt'))
+    by_site = [Shard(site).select(addresses, sites) for site in SITES]
+    assert sorted(sum(by_site, [])) == sorted(addresses)
+    assert all(sites[address] == site for site, selected in zip(SITES, by_site) for address in selected)
+
+    with pytest.raises(ValueError):
+        Shard('4/3')
+
+
+def test_sharded_collectors_merge_into_one_history(fleet, tmp_path):
+    run_collectors(tmp_path, ['1/3', '2/3', '3/3'])
+    partials = tmp_path / 'partials'
+    assert len(list(partials.glob('*.jsonl'))) == 3
+    assert partial_rows(partials) == len(fleet.server.printers)
+
+    with MetricsStore(str(tmp_path / 'printer_metrics.db')) as store:
+        assert merge_partials(store, str(partials)) == len(fleet.server.printers)
+        readings = store.readings()
+    assert sorted(readings['IP Address']) == sorted(fleet.server.printers)
+    assert readings['Printer ID'].is_unique
+
+
+def test_merging_the_same_file_twice_adds_nothing(fleet, tmp_path):
+    run_collectors(tmp_path, ['1/1'])
+    partials = tmp_path / 'partials'
+    with MetricsStore(str(tmp_path / 'printer_metrics.db')) as store:
+        assert merge_partials(store, str(partials)) == len(fleet.server.printers)
+        # The same file again, and a copy of it under another name
+        assert merge_partials(store, str(partials)) == 0
+        path, = partials.glob('*.jsonl')
+        shutil.copy(path, partials / f'copy-{path.name}')
+        assert merge_partials(store, str(partials)) == 0
+        assert len(store.readings()) == len(fleet.server.printers)
+
+
+def test_overlapping_shards_add_each_reading_once(fleet, tmp_path):
+    # The site shards cover the whole fleet a second time
+    run_collectors(tmp_path, ['1/2', '2/2'] + SITES)
+    partials = tmp_path / 'partials'
+    assert partial_rows(partials) == 2 * len(fleet.server.printers)
+    with MetricsStore(str(tmp_path / 'printer_metrics.db')) as store:
+        assert merge_partials(store, str(partials)) == len(fleet.server.printers)
+
+
+def test_printer_ids_stay_the_same_across_shards(fleet, tmp_path):
+    run_collectors(tmp_path, ['1/2', '2/2'])
+    partials = tmp_path / 'partials'
+    with MetricsStore(str(tmp_path / 'printer_metrics.db')) as store:
+        merge_partials(store, str(partials))
+        first = store.readings().set_index('IP Address')['Printer ID']
+
+        # The next round polls the printers from the other shard split, with
+        # their counters moved on
+        for printer in fleet.server.printers.values():
+            printer.a4 += 7
+            printer.a5 += 3
+        run_collectors(tmp_path, SITES)
+        assert merge_partials(store, str(partials)) == len(fleet.server.printers)
+        readings = store.readings()
+    assert len(readings) == 2 * len(fleet.server.printers)
+    assert (readings['Printer ID'] == readings['IP Address'].map(first)).all()
+    assert first.is_unique
+
+
+def test_overlapping_shards_seconds_apart_add_one_reading(tmp_path):
+    partials = tmp_path / 'partials'
+    write_partial([reading('10.0.0.1', '2024-01-02 02:00:01', 100, 5)], Shard('1/2'), str(partials))
+    write_partial([reading('10.0.0.1', '2024-01-02 02:00:04', 100, 5),
+                   reading('10.0.0.1', '2024-01-03 02:00:02', 100, 5)], Shard('2/2'), str(partials))
+    with MetricsStore(str(tmp_path / 'printer_metrics.db')) as store:
+        assert merge_partials(store, str(partials)) == 2
+        assert list(store.readings()['Date']) == ['2024-01-02 02:00:01', '2024-01-03 02:00:02']
@@ -0,0 +1,156 @@
+import glob
+import json
+import logging
+import os
+import re
+import shutil
+
+import pandas as pd
+
+from printer_processing import reading_times, unpivot_usage
+from printer_registry import ip_keys
+
+# Parquet copy of the daily usage for reporting: the long-format usage in
+# append-only part files, and per-period rollups dashboards can read directly
+HISTORY_DIR = 'usage_history'
+
+# Rollup grain: period start of every usage time. The part files keep the
+# time of every reading.
+PERIODS = {
+    'hourly': lambda dates: dates.dt.floor('h'),
+    'daily': lambda dates: dates.dt.normalize(),
+    'weekly': lambda dates: dates.dt.to_period('W-SUN').dt.start_time,
+    'monthly': lambda dates: dates.dt.to_period('M').dt.start_time,
+}
+ROLLUP_KEYS = ['Period', 'Printer ID', 'Page Size', 'WorkCenter ID']
+
+_PART = re.compile(r'part-(\d+)-(\d+)\.parquet$')
+
+
+class UsageHistory:
+    # usage/part-<first>-<last>.parquet holds the long-format usage of the
+    # daily usage rows first..last (reading IDs), one file per update.
+    # rollups/<period>.parquet sums the page counts and cost per period,
+    # printer, page size and workcenter; rollups/_state.json records the last
+    # reading ID they include. Both only ever take in rows past their own
+    # watermark, so an update costs the size of the new usage, not the history.
+    def __init__(self, directory=HISTORY_DIR):
+        self.directory = directory
+        self.usage_dir = os.path.join(directory, 'usage')
+        self.rollup_dir = os.path.join(directory, 'rollups')
+        os.makedirs(self.usage_dir, exist_ok=True)
+        os.makedirs(self.rollup_dir, exist_ok=True)
+
+    # (first, last, path) of every part file, oldest first
+    def parts(self):
+        parts = []
+        for path in glob.glob(os.path.join(self.usage_dir, 'part-*.parquet')):
+            match = _PART.search(path)
+            if match:
+                parts.append((int(match.group(1)), int(match.group(2)), path))
+        return sorted(parts)
+
+    # Last daily usage reading ID in the part files
+    def watermark(self):
+        parts = self.parts()
+        return parts[-1][1] if parts else 0
+
+    def _state_file(self):
+        return os.path.join(self.rollup_dir, '_state.json')
+
+    # Last reading ID included in the rollups
+    def rollup_watermark(self):
+        if not os.path.exists(self._state_file()):
+            return 0
+        with open(self._state_file()) as file:
+            return json.load(file)['reading_id']
+
+    # Long-format usage, optionally only the rows after a reading ID
+    def usage(self, after=0):
+        paths = [path for _, last, path in self.parts() if last > after]
+        if not paths:
+            return pd.DataFrame()
+        usage = pd.concat([pd.read_parquet(path) for path in paths], ignore_index=True)
+        return usage[usage['Reading ID'] > after].reset_index(drop=True)
+
+    def rollup(self, period):
+        path = os.path.join(self.rollup_dir, f'{period}.parquet')
+        return pd.read_parquet(path) if os.path.exists(path) else pd.DataFrame()
+
+    # Drop everything, the next update rebuilds it from the store
+    def reset(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.usage_dir, exist_ok=True)
+        os.makedirs(self.rollup_dir, exist_ok=True)
+
+    # Bring the part files and the rollups up to date with the store's daily
+    # usage. workcenters is the inventory lookup (indexed by normalized IP),
+    # used to tag the usage with the printer's workcenter.
+    def update(self, store, workcenters=None):
+        daily_usage = store.new_daily_usage(self.watermark())
+        if not daily_usage.empty:
+            usage = long_usage(daily_usage, store.pages(), workcenters)
+            first, last = int(daily_usage['Reading ID'].min()), int(daily_usage['Reading ID'].max())
+            _write(usage, os.path.join(self.usage_dir, f'part-{first:012d}-{last:012d}.parquet'))
+            logging.info(f"Added {len(usage)} usage rows to {self.usage_dir}.")
+
+        # Catch the rollups up with the part files, usually just the new one.
+        # A period without a rollup yet (added since) is built from all of them.
+        watermark = self.rollup_watermark()
+        pending = self.usage(watermark)
+        missing = [period for period in PERIODS
+                   if watermark and not os.path.exists(os.path.join(self.rollup_dir, f'{period}.parquet'))]
+        if pending.empty and not missing:
+            return 0
+        history = self.usage() if missing else None
+        for period, period_start in PERIODS.items():
+            usage = history if period in missing else pending
+            if usage.empty:
+                continue
+            added = usage.assign(Period=period_start(usage['Date']))
+            added = added.groupby(ROLLUP_KEYS, dropna=False, as_index=False)[['Page Count', 'Cost']].sum()
+            rollup = pd.concat([self.rollup(period), added], ignore_index=True)
+            # The inventory IDs may have changed type since the rollup was written
+            rollup['WorkCenter ID'] = workcenter_ids(rollup['WorkCenter ID'])
+            rollup = rollup.groupby(ROLLUP_KEYS, dropna=False, as_index=False)[['Page Count', 'Cost']].sum()
+            _write(rollup, os.path.join(self.rollup_dir, f'{period}.parquet'))
+        rolled = history if missing else pending
+        _write_json({'reading_id': int(rolled['Reading ID'].max())}, self._state_file())
+        logging.info(f"Rolled {len(pending)} usage rows into the {', '.join(PERIODS)} rollups"
+                     + (f", built the {', '.join(missing)} rollups from the whole history." if missing else "."))
+        return len(pending)
+
+
+# Long-format usage of daily usage rows with the page size, the cost of the
+# pages from the pages table and the printer's workcenter
+def long_usage(daily_usage, pages, workcenters=None):
+    usage = unpivot_usage(daily_usage, id_columns=('Reading ID', 'Printer ID', 'Date', 'IP Address'))
+    usage['Date'] = reading_times(usage['Date'])
+    usage['Page Count'] = pd.to_numeric(usage['Page Count'], errors='coerce').astype('Int64')
+    usage = usage.merge(pages.rename(columns={'Cost': 'Unit Cost'}), on='Page ID', how='left')
+    usage['Cost'] = usage['Page Count'] * usage.pop('Unit Cost')
+
+    if workcenters is None:
+        usage['WorkCenter ID'] = pd.Series(pd.NA, index=usage.index, dtype='Int64')
+    else:
+        usage['WorkCenter ID'] = workcenter_ids(ip_keys(usage['IP Address']).map(workcenters['WorkCenter ID']))
+    return usage
+
+
+# Workcenter IDs as integers when the inventory has whole numbers only, as
+# text otherwise (nothing makes the inventory column numeric)
+def workcenter_ids(ids):
+    if pd.api.types.is_numeric_dtype(ids) and (ids.dropna() % 1 == 0).all():
+        return ids.astype('Int64')
+    return ids.astype('string')
+
+
+# Write through a temporary file so readers never see half a file
+def _write(df, path):
+    df.to_parquet(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+
+def _write_json(data, path):
+    with open(path + '.tmp', 'w') as file:
+        json.dump(data, file)
+    os.replace(path + '.tmp', path)